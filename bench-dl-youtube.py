@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 mode:python -*-
+
+'''
+Offline benchmark of dl-youtube.py
+
+Runs the real DLYoutube.main pipeline against a local HTTP server serving synthetic media
+generated by ffmpeg, resolved by a youtube-dl extractor stand-in. No network is needed.
+Reports per stage wall and cpu time, bytes moved and rows per minute, on a cold run (empty
+work folder) then a warm run (same work folder, everything already done), as json.
+
+usage:
+  $ python bench-dl-youtube.py --rows 20 --unique 10 -o bench.json -- --jobs 4 --dedup
+  options after '--' are passed to dl-youtube.py
+'''
+
+import argparse
+import datetime
+import functools
+import http.server
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PRJ_ROOT = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_dl_youtube():
+    '''
+    dl-youtube.py is not importable by name (dash), load it from its path
+    '''
+    spec = importlib.util.spec_from_file_location('dl_youtube', os.path.join(PRJ_ROOT, 'dl-youtube.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_media(mediafolder, unique, duration):
+    '''
+    Generate synthetic media served by the fake extractor: per media id a video only mp4,
+    an audio only m4a and an english subtitle, plus one non-youtube video and a cover
+    '''
+    os.makedirs(mediafolder, exist_ok=True)
+    def ffmpeg(*args):
+        subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y'] + list(args), check=True)
+    for i in range(unique):
+        vid = 'media{:04d}'.format(i)
+        if not os.path.isfile(os.path.join(mediafolder, vid + '.mp4')):
+            ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=25', '-t', str(duration),
+                   '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-an',
+                   os.path.join(mediafolder, vid + '.mp4'))
+            ffmpeg('-f', 'lavfi', '-i', 'sine=frequency={}:sample_rate=44100'.format(220 + 10 * i), '-t', str(duration),
+                   '-c:a', 'aac', '-b:a', '128k', os.path.join(mediafolder, vid + '.m4a'))
+            with open(os.path.join(mediafolder, vid + '.en.vtt'), 'wt') as f:
+                f.write('WEBVTT\n\n00:00:00.000 --> 00:00:02.000\n{}\n'.format(vid))
+    if not os.path.isfile(os.path.join(mediafolder, 'lecture.mp4')):
+        ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=25', '-f', 'lavfi', '-i', 'sine=frequency=300',
+               '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+               '-c:a', 'aac', '-shortest', os.path.join(mediafolder, 'lecture.mp4'))
+    if not os.path.isfile(os.path.join(mediafolder, 'cover.png')):
+        ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=600x600', '-frames:v', '1', os.path.join(mediafolder, 'cover.png'))
+
+
+class MediaServer(object):
+    '''
+    Threaded HTTP server of the media folder, counting bytes sent
+    '''
+    def __init__(self, mediafolder):
+        server = self
+        self.bytes_sent = 0
+        self.lock       = threading.Lock()
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def copyfile(self, source, outputfile):
+                start = source.tell()
+                super().copyfile(source, outputfile)
+                with server.lock:
+                    server.bytes_sent += source.tell() - start
+        self.httpd = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                     functools.partial(Handler, directory=mediafolder))
+        self.httpd.daemon_threads = True
+        self.port  = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    #
+    def url(self, path):
+        return 'http://127.0.0.1:{}/{}'.format(self.port, path)
+    #
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+def fake_youtube_extractor(server):
+    '''
+    youtube-dl extractor stand-in for http://127.0.0.1:<port>/youtube/watch?v=<id>,
+    with separate video and audio formats and a subtitle, like youtube
+    '''
+    from youtube_dl.extractor.common import InfoExtractor
+    class FakeYoutubeIE(InfoExtractor):
+        IE_NAME    = 'fakeyoutube'
+        _VALID_URL = r'http://127\.0\.0\.1:\d+/youtube/watch\?v=(?P<id>\w+)'
+        def _real_extract(self, url):
+            vid = self._match_id(url)
+            return {
+                'id'       : vid,
+                'title'    : vid,
+                'formats'  : [
+                    {'format_id': '137', 'url': server.url(vid + '.mp4'), 'ext': 'mp4',
+                     'vcodec': 'avc1', 'acodec': 'none', 'height': 360},
+                    {'format_id': '140', 'url': server.url(vid + '.m4a'), 'ext': 'm4a',
+                     'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128},
+                ],
+                'subtitles': {'en': [{'ext': 'vtt', 'url': server.url(vid + '.en.vtt')}]},
+            }
+    return FakeYoutubeIE()
+
+
+def make_csv(csvfile, server, rows, unique):
+    '''
+    rows cycle through download types 'av', 'a', 'v', every 10th row is a non-youtube video
+    '''
+    dltypes = ('av', 'a', 'v')
+    with open(csvfile, 'wt') as f:
+        for i in range(rows):
+            if i % 10 == 9:
+                link = server.url('lecture.mp4')
+                dltype = 'v'
+            else:
+                link = server.url('youtube/watch?v=media{:04d}'.format(i % unique))
+                dltype = dltypes[i % len(dltypes)]
+            f.write('{}, {}, Bench Artist, Album {}, Song {}, Bench Artist, Pop, 2020, cover.png\n'.format(
+                dltype, link, i % 5, i))
+
+
+def folder_bytes(folder):
+    total = 0
+    for root, _, fnames in os.walk(folder):
+        for fname in fnames:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+    return total
+
+
+def run(dl, workfolder, csvfile, server, opts, scenario):
+    '''
+    One DLYoutube.main run. Returns its results
+    '''
+    stages = {}
+    lock   = threading.Lock()
+    class BenchDLYoutube(dl.DLYoutube):
+        TEMP_FOLDER = os.path.join(workfolder, 'tmp')
+    # time each stage call, wall and cpu of the calling thread
+    for name in ('stage_download', 'stage_normalize', 'stage_tag'):
+        def timed(self, job, _name=name, _func=getattr(dl.DLYoutube, name)):
+            wall, cpu = time.monotonic(), time.thread_time()
+            try:
+                return _func(self, job)
+            finally:
+                wall, cpu = time.monotonic() - wall, time.thread_time() - cpu
+                with lock:
+                    stat = stages.setdefault(_name[len('stage_'):], {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+                    stat['calls'] += 1
+                    stat['wall']  += wall
+                    stat['cpu']   += cpu
+        setattr(BenchDLYoutube, name, timed)
+    #
+    sent_before   = server.bytes_sent
+    self_before   = resource.getrusage(resource.RUSAGE_SELF)
+    child_before  = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall          = time.monotonic()
+    engine = BenchDLYoutube(inputlist=csvfile, folderoutput=os.path.join(workfolder, 'output'),
+                            coverfolder=os.path.join(workfolder, 'cover'),
+                            extractors=[fake_youtube_extractor(server)], **opts)
+    try:
+        engine.main()
+    finally:
+        engine.stop_logging()
+    wall          = time.monotonic() - wall
+    self_after    = resource.getrusage(resource.RUSAGE_SELF)
+    child_after   = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rows          = engine.rows_read
+    return {
+        'scenario'     : scenario,
+        'rows'         : rows,
+        'wall'         : round(wall, 3),
+        'rows_per_min' : round(rows * 60.0 / wall, 2) if wall else None,
+        'cpu_python'   : round(self_after.ru_utime - self_before.ru_utime + self_after.ru_stime - self_before.ru_stime, 3),
+        'cpu_ffmpeg'   : round(child_after.ru_utime - child_before.ru_utime + child_after.ru_stime - child_before.ru_stime, 3),
+        'http_bytes'   : server.bytes_sent - sent_before,
+        'tmp_bytes'    : folder_bytes(os.path.join(workfolder, 'tmp')),
+        'output_bytes' : folder_bytes(os.path.join(workfolder, 'output')),
+        'stages'       : {k: {'calls': v['calls'], 'wall': round(v['wall'], 3), 'cpu': round(v['cpu'], 3)}
+                          for k, v in stages.items()},
+        'metrics'      : engine.metrics.summary(),  # dl-youtube.py own per step timing
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of dl-youtube.py')
+    parser.add_argument('--rows', type=int, default=10, help='Number of csv rows')
+    parser.add_argument('--unique', type=int, default=None, help='Number of distinct media (default: rows)')
+    parser.add_argument('--duration', type=float, default=30, help='Media duration in seconds')
+    parser.add_argument('--scenarios', default='cold,warm', help='Comma separated: cold, warm')
+    parser.add_argument('--media-folder', dest='mediafolder', default=os.path.join(tempfile.gettempdir(), 'dl-youtube-bench-media'),
+                        help='Generated media, kept between benchmark runs')
+    parser.add_argument('--work-folder', dest='workfolder', default=None, help='Work folder (default: temporary)')
+    parser.add_argument('-o', '--output', default='bench_output.json', help='Results json file')
+    parser.add_argument('dlopts', nargs=argparse.REMAINDER, help='dl-youtube.py options, after --')
+    args = parser.parse_args()
+    unique = args.unique or args.rows
+    #
+    if shutil.which('ffmpeg') is None:
+        sys.exit('ffmpeg is not found!')
+    dl = load_dl_youtube()
+    # dl-youtube.py own option parsing for the pass through options, input list and folders are set by run()
+    dlargs = [a for a in args.dlopts if a != '--']
+    opts = dl.args_to_opts(dl.option_parser().parse_args(['-i', '-'] + dlargs))
+    for k in ('inputlist', 'folderoutput', 'coverfolder'):
+        del opts[k]
+    #
+    make_media(args.mediafolder, unique, args.duration)
+    server = MediaServer(args.mediafolder)
+    workfolder = args.workfolder or tempfile.mkdtemp(prefix='dl-youtube-bench-')
+    for d in ('output', 'cover'):
+        os.makedirs(os.path.join(workfolder, d), exist_ok=True)
+    shutil.copy(os.path.join(args.mediafolder, 'cover.png'), os.path.join(workfolder, 'cover'))
+    csvfile = os.path.join(workfolder, 'list.csv')
+    make_csv(csvfile, server, args.rows, unique)
+    #
+    results = {
+        'version'   : dl.__version__,
+        'date'      : datetime.datetime.now().isoformat(),
+        'config'    : {'rows': args.rows, 'unique': unique, 'duration': args.duration,
+                       'cpu_count': os.cpu_count(), 'options': dlargs},
+        'runs'      : [],
+    }
+    try:
+        for scenario in args.scenarios.split(','):
+            result = run(dl, workfolder, csvfile, server, opts, scenario)
+            results['runs'].append(result)
+            print('{scenario}: {rows} rows in {wall}s, {rows_per_min} rows/min'.format(**result))
+    finally:
+        server.shutdown()
+        if args.workfolder is None:
+            shutil.rmtree(workfolder, ignore_errors=True)
+    with open(args.output, 'wt') as f:
+        json.dump(results, f, indent=2)
+    print('Results: {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
+
+# eof
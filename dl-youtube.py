@@ -1,15 +1,48 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 mode:python -*-
 
+import argparse
+import atexit
+import contextlib
+import copy
 import csv
 import datetime
+import glob
+import hashlib
+import http.server
+import importlib
+import importlib.util
+import io
+import json
 import logging
+import logging.handlers
 import os
 import pprint
+import queue
+import random
 import re
 import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import subprocess
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+    FICLONE = 0x40049409  # linux ioctl, reflink on btrfs, xfs, etc
+except ImportError:
+    pass
+try:
+    import resource
+except ImportError:
+    resource = None   # no cpu time per ffmpeg process on this platform
 
 
 class DLException(Exception): pass
@@ -29,44 +62,62 @@ if sys.version_info < (3, 6):
         traceback.print_exc()
         sys.exit(1)
 
-try:
-    from mutagen.id3 import (APIC, ID3, LINK, TALB, TCON, TDAT, TIT2, TPE1, TPE2, TYER)
-except ImportError:
-    try:
-        raise DLReqError('\nNeed mutagen library')
-    except:
-        traceback.print_exc()
-        sys.exit(1)
+# media stack, imported when first needed (slow to import), so --version, --help and --plan start fast
+REQUIRED_MODULES = {'youtube_dl'      : 'youtube-dl',
+                    'mutagen.id3'     : 'mutagen',
+                    'ffmpeg_normalize': 'ffmpeg-normalize'}
 
-try:
-    import youtube_dl
-except ImportError:
-    try:
-        raise DLReqError('\nNeed youtube-dl library')
-    except:
-        traceback.print_exc()
-        sys.exit(1)
-
-try:
-    from ffmpeg_normalize import FFmpegNormalize
-except ImportError:
+def need(module):
+    '''
+    Module of the media stack, imported on first use
+    '''
     try:
-        raise DLReqError('\nNeed ffmpeg-normalize library')
-    except:
-        traceback.print_exc()
-        sys.exit(1)
+        return importlib.import_module(module)
+    except ImportError:
+        raise DLReqError('\nNeed {} library'.format(REQUIRED_MODULES[module]))
 
-# check executables
-if shutil.which('ffmpeg') is None:
-    msg =  '\nffmpeg is not found!'
-    msg += '\nPlease install: $ sudo apt install ffmpeg'
-    raise DLReqError(msg)
+def check_requirements():
+    '''
+    Fail early, before any row is processed, without importing the media stack
+    '''
+    for module, package in REQUIRED_MODULES.items():
+        if importlib.util.find_spec(module.split('.')[0]) is None:
+            raise DLReqError('\nNeed {} library'.format(package))
+    # check executables
+    if shutil.which('ffmpeg') is None:
+        msg =  '\nffmpeg is not found!'
+        msg += '\nPlease install: $ sudo apt install ffmpeg'
+        raise DLReqError(msg)
 
-__version_info__ = (0, 8, 4)
+__version_info__ = (0, 9, 0)
 __version__ = '.'.join(str(c) for c in __version_info__)
 __progname_version__ = __file__ + ' ' + __version__
 
 # version history
+# v0.9.0
+# - Process csv rows concurrently (--jobs) with per-host download limit (--host-jobs)
+# - Staged download, normalize and tag pipeline with bounded queues (--norm-jobs, --tag-jobs, --queue-size)
+# - Option to extract MP3 from already downloaded video for 'av' rows (--audio-from-video)
+# - Option to cache loudness measurement by input file content (--loudness-cache)
+# - Option to encode MP3 once, normalizing straight from the downloaded audio stream (--single-encode)
+# - SQLite job index for skip and resume decisions (--job-db, --verify)
+# - Reuse YoutubeDL instances and resolve each link once, optionally cached on disk (--info-ttl)
+# - Content addressed store, a media shared by several rows is downloaded and normalized once (--dedup)
+# - Cover art read once per run, with its real mime type, optionally downscaled (--cover-max-size)
+# - Atomic output placement with hardlink, reflink, rename or copy (--place)
+# - Offline benchmark: bench-dl-youtube.py
+# - Per stage timing and throughput in tmp/dl-youtube_*.events.jsonl, optionally to Prometheus (--metrics-textfile)
+# - Input rows are read as processed. Split rows across nodes by shard (--shard) or leases (--lease-dir, --lease-ttl)
+# - Daemon mode with job api and watch folder (--daemon, --listen, --watch-folder)
+# - Media stack imported when first needed. Dry run of the steps of each row (--plan)
+# - Retry rows failing on transient errors with backoff (--retries, --retry-delay), failed rows in tmp/failed-*.csv
+# - Resume partial downloads. Per host request rate and bandwidth limit (--host-rate, --limit-rate)
+# - Temporary files kept under a size budget, least recently used first (--tmp-budget)
+# - Update ID3 tag of MP3 in output folder without downloading nor normalizing (--retag)
+# - Playlist and channel rows ('pa', 'pv', 'pav') synced against a download archive (--download-archive, --playlist-end)
+# - Log written by a background thread, download progress kept per row and logged less often (--progress-interval)
+# - ffmpeg threads per process by its work within a core budget (--ffmpeg-cores), cpu time per step in metrics
+# - Option to merge, embed subtitle and normalize youtube video in one remux, video stream copied (--one-pass-video)
 # v0.8.4
 # - Download and embed English subtitle (only file subtitle, not stream) from YouTube video
 # v0.8.3
@@ -84,6 +135,1223 @@ __progname_version__ = __file__ + ' ' + __version__
 #   $ python -m nuitka --standalone --show-progress --show-scons dl-youtube.py
 # - add -v for youtube-dl
 
+def file_digest(fpath, blocksize=1 << 20):
+    '''
+    sha1 of the file content
+    '''
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+PLACE_STRATEGIES = ('auto', 'hardlink', 'reflink', 'rename', 'copy')
+
+def parse_bytes(value):
+    '''
+    '500K', '2M', '1.5G' or a number to bytes, None when not given
+    '''
+    if not value:
+        return None
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', str(value), re.IGNORECASE)
+    if m is None:
+        raise DLInvalidOption('Invalid size: {}'.format(value))
+    return int(float(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2).lower() or ' '))
+
+def place_file(src, dst, strategy='auto'):
+    '''
+    Place src at dst, atomically: it is written under a temporary name next to dst, then renamed,
+    so an interrupted write never leaves a partial dst.
+    strategy:
+      'rename'  : move src (not needed anymore)
+      'hardlink': share src (neither file is modified later)
+      'reflink' : copy on write clone (btrfs, xfs, ...)
+      'copy'    : plain copy
+      'auto'    : hardlink, else reflink, else copy
+    Falls back to copy when the strategy is not possible, e.g. dst on another filesystem.
+    Returns the method used.
+    '''
+    if strategy == 'rename':
+        try:
+            os.replace(src, dst)
+            return 'rename'
+        except OSError:
+            pass  # other filesystem, copy then remove src
+    tmp = dst + '.tmp'
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    method = None
+    if strategy in ('auto', 'hardlink'):
+        try:
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:
+            pass
+    if method is None and strategy in ('auto', 'reflink'):
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except (OSError, NameError):  # NameError: no fcntl on this platform
+            pass
+    if method is None:
+        shutil.copyfile(src, tmp)
+        method = 'copy'
+    os.replace(tmp, dst)
+    if strategy == 'rename':
+        os.remove(src)
+    return method
+
+class DLTemplateFields(dict):
+    '''
+    Fields of youtube-dl output template ('%(title)s'), 'NA' when missing like youtube-dl
+    '''
+    def __missing__(self, key):
+        return 'NA'
+
+class DLJob(object):
+    '''
+    Working state of one input csv row. Each row owns its own, so rows can run concurrently.
+    '''
+    def __init__(self, od, rowid=None):
+        self.od               = od      # input csv row (dict)
+        self.rowid            = rowid   # row number in input list
+        self.source           = None    # where the row comes from: input list, api, watched csv
+        self.status           = 'queued'
+        self.error            = None    # why the row failed
+        self.failure          = None    # 'transient' or 'permanent', when failed
+        self.attempts         = 0       # retries so far
+        self.protected        = []      # temporary path prefixes protected from eviction while in flight
+        self.progress         = None    # last youtube-dl progress: status, bytes, speed, eta. Set by DLYoutube.ydl_hook
+        self.progress_logged  = 0       # time.monotonic() of last progress logged
+        self.downloaded_fname = None    # set by DLYoutube.ydl_hook
+        self.downloaded_bytes = 0       # set by DLYoutube.ydl_hook
+        self.downloaded_time  = None    # time.monotonic() of last finished download, set by DLYoutube.ydl_hook
+        self.media_key        = None    # set by DLYoutube.media_key
+        # set by the stages, None means nothing to do for the next stage
+        self.videotmpfpath    = None    # downloaded video
+        self.videonormfpath   = None    # normalized video, next to target video
+        self.videofpath       = None    # target video
+        self.audiotmpfpath    = None    # downloaded audio
+        self.audionormfpath   = None    # normalized audio, next to target audio
+        self.audiofpath       = None    # target audio
+
+class DLPipeline(object):
+    '''
+    Stages connected by bounded queues, each stage with its own executor.
+    A job failing in one stage is logged and not passed to the next stage, unless
+    retry(job, exception) returns a delay (seconds) after which the stage is run again.
+    on_finish(job) is called for each job done or failed.
+    '''
+    SENTINEL = None
+    #
+    def __init__(self, stages, queuesize, logger, on_finish=None, retry=None):
+        self.stages    = stages  # list of (name, func, workers)
+        self.logger    = logger
+        self.on_finish = on_finish
+        self.retry     = retry
+        self.pending   = 0       # jobs submitted and not finished, including those waiting for a retry
+        self.queues    = [queue.Queue(maxsize=max(1, queuesize)) for _ in stages]
+        self.executors = [ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+                          for name, _, workers in stages]
+        self.running   = [workers for _, _, workers in stages]  # live workers per stage
+        self.lock      = threading.Lock()
+        self.idle      = threading.Condition(self.lock)
+    #
+    def start(self):
+        for i, (_, _, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                self.executors[i].submit(self.worker, i)
+    #
+    def submit(self, job):
+        with self.lock:
+            self.pending += 1
+        # blocks when the first stage is full
+        self.queues[0].put(job)
+    #
+    def join(self):
+        # wait for the jobs, a job may still be retried by any stage
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        # no more jobs, stop the first stage. Next stages are stopped by its previous stage
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(self.SENTINEL)
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+    #
+    def worker(self, i):
+        name, func, _ = self.stages[i]
+        while True:
+            job = self.queues[i].get()
+            if job is self.SENTINEL:
+                break
+            job.status = name
+            try:
+                func(job)
+            except DLYoutubeDLError as e:
+                job.error  = str(e)
+                self.logger.error('ERROR:: DLYoutubeDLError {}'.format(e))
+                self.failed(i, job, e)
+                continue
+            except Exception as e:
+                job.error  = str(e)
+                self.logger.error('ERROR:: {}'.format(e))
+                self.failed(i, job, e)
+                continue
+            if i + 1 < len(self.stages):
+                self.queues[i + 1].put(job)  # blocks when next stage is full
+            else:
+                job.status = 'done'
+                self.finished(job)
+        # last worker of this stage stops the next stage
+        with self.lock:
+            self.running[i] -= 1
+            last = self.running[i] == 0
+        if last and i + 1 < len(self.stages):
+            for _ in range(self.stages[i + 1][2]):
+                self.queues[i + 1].put(self.SENTINEL)
+    #
+    def failed(self, i, job, exc):
+        delay = None
+        if self.retry is not None:
+            try:
+                delay = self.retry(job, exc)
+            except Exception as e:
+                self.logger.error('ERROR:: {}'.format(e))
+        if delay is None:
+            job.status = 'failed'
+            self.finished(job)
+            return
+        job.status = 'retrying'
+        self.logger.info('INFO:: Retrying stage {} of row {} in {:.0f}s (retry {})'.format(
+            self.stages[i][0], job.rowid, delay, job.attempts))
+        # not by the worker, it must not wait, and the queue may be full
+        timer = threading.Timer(delay, self.queues[i].put, [job])
+        timer.daemon = True
+        timer.start()
+    #
+    def defer(self, delay, func, *args):
+        '''
+        Run func(*args) after delay seconds, e.g. to submit a row again. join() waits for it
+        '''
+        with self.lock:
+            self.pending += 1
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                self.logger.error('ERROR:: {}'.format(e))
+            finally:
+                with self.idle:
+                    self.pending -= 1
+                    self.idle.notify_all()
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+    #
+    def finished(self, job):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                self.logger.error('ERROR:: {}'.format(e))
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+
+class DLMetrics(object):
+    '''
+    Per stage timing and throughput. Each measured step is an event (json line) in eventfile,
+    and is summed up per stage and outcome into a Prometheus textfile collector file (promfile),
+    when given.
+    '''
+    BUCKETS = (1, 5, 15, 60, 300, 900, 3600, float('inf'))  # seconds, histogram of step duration
+    #
+    def __init__(self, eventfile, promfile, logger):
+        self.eventfile = eventfile
+        self.promfile  = promfile
+        self.logger    = logger
+        self.lock      = threading.Lock()
+        self.tls       = threading.local()  # job of the calling thread
+        self.stages    = {}                 # (stage, outcome) -> {'count', 'seconds', 'bytes', 'cpu', 'buckets'}
+        self.rows      = {}                 # row status -> count
+        self.events    = open(self.eventfile, 'at', buffering=1) if self.eventfile else None
+    #
+    def set_job(self, job):
+        self.tls.job = job
+    #
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        '''
+        Measure the enclosed step. The caller may add fields (e.g. 'bytes') to the yielded event
+        '''
+        event = dict(fields)
+        start = time.monotonic()
+        try:
+            yield event
+        except BaseException as e:
+            event['outcome'] = 'error'
+            event['error']   = str(e)
+            raise
+        finally:
+            event.setdefault('outcome', 'ok')
+            event['seconds'] = round(time.monotonic() - start, 3)
+            self.record(stage, event)
+    #
+    def record(self, stage, event):
+        job = getattr(self.tls, 'job', None)
+        if event.get('bytes') and event['seconds'] > 0:
+            event['bitrate'] = int(event['bytes'] * 8 / event['seconds'])  # bit/s
+        event = {'time': round(time.time(), 3), 'stage': stage,
+                 'row': getattr(job, 'rowid', None), 'song': getattr(job, 'song', None),
+                 **event}
+        with self.lock:
+            stat = self.stages.setdefault((stage, event['outcome']),
+                                          {'count': 0, 'seconds': 0.0, 'bytes': 0, 'cpu': 0.0, 'buckets': [0] * len(self.BUCKETS)})
+            stat['count']   += 1
+            stat['seconds'] += event['seconds']
+            stat['bytes']   += event.get('bytes') or 0
+            stat['cpu']     += event.get('cpu') or 0
+            for i, le in enumerate(self.BUCKETS):
+                if event['seconds'] <= le:
+                    stat['buckets'][i] += 1
+            if self.events is not None:
+                self.events.write(json.dumps(event, default=str) + '\n')
+    #
+    def row_finished(self, job):
+        with self.lock:
+            self.rows[job.status] = self.rows.get(job.status, 0) + 1
+        self.write_textfile()
+    #
+    def summary(self):
+        '''
+        {stage: {outcome: {'count', 'seconds', 'bytes', 'cpu'}}}
+        '''
+        with self.lock:
+            summary = {}
+            for (stage, outcome), stat in sorted(self.stages.items()):
+                summary.setdefault(stage, {})[outcome] = {k: round(v, 3) if isinstance(v, float) else v
+                                                          for k, v in stat.items() if k != 'buckets'}
+            return summary
+    #
+    def write_textfile(self):
+        if not self.promfile:
+            return
+        lines = ['# HELP dl_youtube_stage_seconds Duration of pipeline steps.',
+                 '# TYPE dl_youtube_stage_seconds histogram']
+        with self.lock:
+            for (stage, outcome), stat in sorted(self.stages.items()):
+                labels = 'stage="{}",outcome="{}"'.format(stage, outcome)
+                for le, count in zip(self.BUCKETS, stat['buckets']):
+                    lines.append('dl_youtube_stage_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, '+Inf' if le == float('inf') else le, count))
+                lines.append('dl_youtube_stage_seconds_sum{{{}}} {:.3f}'.format(labels, stat['seconds']))
+                lines.append('dl_youtube_stage_seconds_count{{{}}} {}'.format(labels, stat['count']))
+            lines += ['# HELP dl_youtube_stage_bytes_total Bytes produced by pipeline steps.',
+                      '# TYPE dl_youtube_stage_bytes_total counter']
+            for (stage, outcome), stat in sorted(self.stages.items()):
+                lines.append('dl_youtube_stage_bytes_total{{stage="{}",outcome="{}"}} {}'.format(stage, outcome, stat['bytes']))
+            lines += ['# HELP dl_youtube_stage_cpu_seconds_total CPU time of the ffmpeg processes of pipeline steps.',
+                      '# TYPE dl_youtube_stage_cpu_seconds_total counter']
+            for (stage, outcome), stat in sorted(self.stages.items()):
+                lines.append('dl_youtube_stage_cpu_seconds_total{{stage="{}",outcome="{}"}} {:.3f}'.format(stage, outcome, stat['cpu']))
+            lines += ['# HELP dl_youtube_rows_total Input rows by final status.',
+                      '# TYPE dl_youtube_rows_total counter']
+            for status, count in sorted(self.rows.items()):
+                lines.append('dl_youtube_rows_total{{status="{}"}} {}'.format(status, count))
+            tmpfile = self.promfile + '.tmp'
+            with open(tmpfile, 'wt') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmpfile, self.promfile)
+    #
+    def close(self):
+        self.write_textfile()
+        if self.events is not None:
+            self.events.close()
+
+class DLTokenBucket(object):
+    '''
+    At most rate acquisitions per second on average, up to burst at once
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate   = rate
+        self.burst  = max(1, burst)
+        self.tokens = self.burst
+        self.stamp  = time.monotonic()
+        self.lock   = threading.Lock()
+    #
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp  = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DLCpuScheduler(object):
+    '''
+    Core budget shared by the ffmpeg processes. Each process is given a number of threads
+    (-threads) by its work, and waits until that many cores are free, so concurrent
+    normalizations and post processing never run more threads than cores. Only a video
+    re-encode gets more threads, by its duration. Audio encodes, and normalizations and remuxes
+    copying the video, get one, so they pack densely.
+    '''
+    VIDEO_SECONDS_PER_THREAD = 120  # one more thread per this much re-encoded video duration
+    #
+    def __init__(self, cores):
+        self.cores   = max(1, cores)
+        self.used    = 0    # cores held
+        self.running = 0    # processes holding cores
+        self.started = 0    # processes started, to tell whether one ran alone
+        self.cond    = threading.Condition()
+    #
+    def threads(self, kind, duration=None):
+        '''
+        Threads of an ffmpeg process re-encoding 'video', or encoding 'audio' only (the video, if any,
+        copied), of duration seconds (None: unknown)
+        '''
+        if kind != 'video':
+            return 1
+        if not duration:
+            return max(1, self.cores // 2)
+        return max(1, min(self.cores, -(-int(duration) // self.VIDEO_SECONDS_PER_THREAD)))
+    #
+    @contextlib.contextmanager
+    def slot(self, threads, event):
+        '''
+        Hold threads cores for the enclosed ffmpeg process(es). Their cpu time, from run() or,
+        for processes started by libraries, from the children usage when nothing else ran meanwhile,
+        and utilisation of the held cores are added to event (metrics)
+        '''
+        threads = min(threads, self.cores)
+        with self.cond:
+            while self.used + threads > self.cores:
+                self.cond.wait()
+            self.used    += threads
+            self.running += 1
+            self.started += 1
+            alone   = self.running == 1
+            started = self.started
+        usage = {'cpu': None}
+        before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource is not None else None
+        start  = time.monotonic()
+        try:
+            yield usage
+        finally:
+            wall  = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN) if resource is not None else None
+            with self.cond:
+                alone = alone and self.started == started
+                self.used    -= threads
+                self.running -= 1
+                self.cond.notify_all()
+            cpu = usage['cpu']
+            if cpu is None and alone and before is not None:
+                cpu = after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+            event['threads'] = threads
+            if cpu is not None:
+                event['cpu'] = round(cpu, 3)
+                if wall > 0:
+                    event['cpu_util'] = round(cpu / (wall * threads), 3)
+    #
+    def run(self, cmd, threads, event):
+        '''
+        Run ffmpeg cmd (its -threads given by the caller) in a slot of threads cores.
+        Returns (returncode, stderr)
+        '''
+        with self.slot(threads, event) as usage:
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            if not hasattr(os, 'wait4'):
+                _, stderr = proc.communicate()
+                return proc.returncode, stderr
+            stderr = proc.stderr.read()
+            proc.stderr.close()
+            # reaped here, not by proc.wait(), for the cpu time of this process alone
+            _, status, rusage = os.wait4(proc.pid, 0)
+            # os.waitstatus_to_exitcode is python 3.9+
+            proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            usage['cpu'] = rusage.ru_utime + rusage.ru_stime
+            return proc.returncode, stderr
+
+class DLLoudnorm(object):
+    '''
+    Two pass EBU R128 loudness normalization with ffmpeg loudnorm filter, same settings as
+    FFmpegNormalize(dual_mono=True, target_level=-14). The first pass (measurement) is cached
+    by input file content, so normalizing the same input again runs the second pass only.
+    Without cachefile, measurements are kept for the run only.
+    '''
+    AUDIO_ONLY_EXT = ('.mp3', '.m4a', '.aac', '.opus', '.ogg', '.flac', '.wav')
+    #
+    def __init__(self, cachefile, logger, metrics, cpu, target_level=-14.0, loudness_range_target=7.0, true_peak=-2.0):
+        self.cachefile    = cachefile
+        self.logger       = logger
+        self.metrics      = metrics  # DLMetrics
+        self.cpu          = cpu      # DLCpuScheduler
+        self.target_level = target_level
+        self.lra_target   = loudness_range_target
+        self.true_peak    = true_peak
+        self.hits         = 0
+        self.misses       = 0
+        self.lock         = threading.Lock()
+        self.cache        = {}  # content hash -> measured stats
+        try:
+            with open(self.cachefile, 'rt') as f:
+                self.cache = json.load(f)
+        except (OSError, TypeError, ValueError):
+            pass
+    #
+    def loudnorm_filter(self, **measured):
+        opts = ['I={}'.format(self.target_level), 'LRA={}'.format(self.lra_target),
+                'TP={}'.format(self.true_peak), 'dual_mono=true']
+        opts += ['{}={}'.format(k, v) for k, v in measured.items()]
+        return 'loudnorm=' + ':'.join(opts + ['print_format=json'])
+    #
+    def measure(self, infile, threads=1):
+        '''
+        First pass. Returns dict of input_i, input_lra, input_tp, input_thresh, target_offset, sample_rate
+        '''
+        key = file_digest(infile)
+        with self.lock:
+            stats = self.cache.get(key)
+            if stats is not None:
+                self.hits += 1
+        if stats is not None:
+            self.logger.debug('DEBUG:: Loudness cache hit: {}'.format(infile))
+            return stats
+        #
+        self.logger.debug('DEBUG:: Loudness cache miss, measuring: {}'.format(infile))
+        cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-threads', str(threads), '-i', infile, '-map', '0:a:0',
+               '-af', self.loudnorm_filter(), '-vn', '-sn', '-threads', str(threads), '-f', 'null', os.devnull]
+        with self.metrics.span('loudness_measure', file=infile, bytes=os.path.getsize(infile)) as event:
+            returncode, stderr = self.cpu.run(cmd, threads, event)
+            if returncode != 0:
+                raise DLCommandError('ffmpeg failed measuring loudness of {}: {}'.format(infile, stderr[-1000:]))
+        # loudnorm prints its json as the last block of the output
+        measured = json.loads(stderr[stderr.rindex('{'):stderr.rindex('}') + 1])
+        samplerate = re.search(r'Stream #.*: Audio: .*?(\d+) Hz', stderr)
+        stats = {k: measured[k] for k in ('input_i', 'input_lra', 'input_tp', 'input_thresh', 'target_offset')}
+        stats['sample_rate'] = samplerate.group(1) if samplerate else '48000'
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = stats
+            self.save()
+        return stats
+    #
+    def save(self):
+        if not self.cachefile:
+            return
+        tmpfile = self.cachefile + '.tmp'
+        with open(tmpfile, 'wt') as f:
+            json.dump(self.cache, f, indent=1)
+        os.replace(tmpfile, self.cachefile)
+    #
+    def normalize(self, infile, outfile, audio_codec='libmp3lame', audio_bitrate='320k', threads=1):
+        '''
+        Second pass, with measured values from cache (or from the first pass)
+        '''
+        stats = self.measure(infile, threads)
+        af = self.loudnorm_filter(measured_I=stats['input_i'], measured_LRA=stats['input_lra'],
+                                  measured_TP=stats['input_tp'], measured_thresh=stats['input_thresh'],
+                                  offset=stats['target_offset'], linear='true')
+        if os.path.splitext(outfile)[1].lower() in self.AUDIO_ONLY_EXT:
+            maps = ['-map', '0:a:0']
+        else:
+            # keep video and subtitle as is, like FFmpegNormalize does
+            maps = ['-map', '0', '-c:v', 'copy', '-c:s', 'copy']
+        tmpfile = '{}.part{}'.format(*os.path.splitext(outfile))
+        cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-y', '-threads', str(threads), '-i', infile] + maps + \
+              ['-map_metadata', '0', '-af', af, '-c:a', audio_codec, '-b:a', audio_bitrate,
+               '-ar', stats['sample_rate'], '-threads', str(threads), tmpfile]
+        self.logger.debug('DEBUG:: Running: {}'.format(' '.join(cmd)))
+        with self.metrics.span('normalize_encode', file=outfile) as event:
+            returncode, stderr = self.cpu.run(cmd, threads, event)
+            if returncode != 0:
+                raise DLCommandError('ffmpeg failed normalizing {}: {}'.format(infile, stderr[-1000:]))
+            os.replace(tmpfile, outfile)
+            event['bytes'] = os.path.getsize(outfile)
+    #
+    def remux(self, videofile, audiofile, subfiles, outfile, audio_codec='libmp3lame', audio_bitrate='320k'):
+        '''
+        Merge a video stream, an audio stream and subtitles ([(file, language code)]) into outfile
+        (mkv) in one pass: the video is copied, only the audio is normalized and encoded
+        '''
+        iso639 = need('youtube_dl').utils.ISO639Utils
+        threads = self.cpu.threads('audio')
+        stats = self.measure(audiofile, threads)
+        af = self.loudnorm_filter(measured_I=stats['input_i'], measured_LRA=stats['input_lra'],
+                                  measured_TP=stats['input_tp'], measured_thresh=stats['input_thresh'],
+                                  offset=stats['target_offset'], linear='true')
+        inputs = ['-i', videofile, '-i', audiofile]
+        maps   = ['-map', '0:v:0', '-map', '1:a:0']
+        for i, (subfile, language) in enumerate(subfiles):
+            inputs += ['-i', subfile]
+            maps   += ['-map', '{}:s:0'.format(i + 2), '-metadata:s:s:{}'.format(i),
+                       'language=' + (iso639.short2long(language) or language)]
+        tmpfile = '{}.part{}'.format(*os.path.splitext(outfile))
+        cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-y'] + inputs + maps + \
+              ['-map_metadata', '0', '-c:v', 'copy', '-c:s', 'srt',
+               '-af', af, '-c:a', audio_codec, '-b:a', audio_bitrate, '-ar', stats['sample_rate'],
+               '-threads', str(threads), tmpfile]
+        self.logger.debug('DEBUG:: Running: {}'.format(' '.join(cmd)))
+        with self.metrics.span('remux', file=outfile,
+                               input_bytes=sum(os.path.getsize(f) for f in [videofile, audiofile] + [f for f, _ in subfiles])) as event:
+            returncode, stderr = self.cpu.run(cmd, threads, event)
+            if returncode != 0:
+                raise DLCommandError('ffmpeg failed remuxing {}: {}'.format(videofile, stderr[-1000:]))
+            os.replace(tmpfile, outfile)
+            event['bytes'] = os.path.getsize(outfile)
+
+class DLJobIndex(object):
+    '''
+    SQLite record of the finished stages of each row target (its video and audio), with file
+    path, size and sha1. All records are loaded at start, so skip decisions are dict lookups
+    instead of probing the filesystem. A readonly index (dry run) records in memory only.
+    '''
+    STAGES = ('downloaded', 'normalized', 'tagged')  # 'tagged': tagged and placed in output folder
+    #
+    def __init__(self, dbfile, logger, readonly=False):
+        self.logger   = logger
+        self.lock     = threading.Lock()
+        self.readonly = readonly
+        self.records  = {}
+        if readonly:
+            self.db = sqlite3.connect(dbfile, check_same_thread=False) if os.path.isfile(dbfile) else None
+        else:
+            self.db = sqlite3.connect(dbfile, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS stages ('
+                            'target TEXT, kind TEXT, stage TEXT, path TEXT, size INTEGER, hash TEXT, updated REAL, '
+                            'PRIMARY KEY (target, kind, stage))')
+            self.db.commit()
+        if self.db is not None:
+            try:
+                self.records = {(target, kind, stage): path for target, kind, stage, path in
+                                self.db.execute('SELECT target, kind, stage, path FROM stages')}
+            except sqlite3.OperationalError:  # readonly, no table yet
+                pass
+    #
+    def get(self, target, kind, stage):
+        return self.records.get((target, kind, stage))
+    #
+    def record(self, target, kind, stage, fpath, digest=True):
+        # digest: True to hash fpath, the sha1 when known already (same content under another name),
+        # False for files found on disk or not kept, their hash is filled in by verify()
+        if self.readonly:
+            with self.lock:
+                self.records[(target, kind, stage)] = fpath
+            return
+        size = os.path.getsize(fpath)
+        sha1 = (file_digest(fpath) if digest is True else digest) or None
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (target, kind, stage, fpath, size, sha1, time.time()))
+            self.db.commit()
+            self.records[(target, kind, stage)] = fpath
+    #
+    def digest(self, target, kind, stage):
+        '''
+        Recorded sha1 of a stage file, None if not hashed yet
+        '''
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM stages WHERE target = ? AND kind = ? AND stage = ?',
+                                  (target, kind, stage)).fetchone()
+        return row[0] if row else None
+    #
+    def forget(self, target, kind, stage):
+        with self.lock:
+            if self.readonly:
+                self.records.pop((target, kind, stage), None)
+                return
+            self.db.execute('DELETE FROM stages WHERE target = ? AND kind = ? AND stage = ?', (target, kind, stage))
+            self.db.commit()
+            self.records.pop((target, kind, stage), None)
+    #
+    def forget_path(self, fpath):
+        '''
+        Drop the records of a removed file
+        '''
+        with self.lock:
+            self.db.execute('DELETE FROM stages WHERE path = ?', (fpath,))
+            self.db.commit()
+            for key in [key for key, path in self.records.items() if path == fpath]:
+                del self.records[key]
+    #
+    def verify(self):
+        '''
+        Reconcile records against disk. Records whose file is gone or changed are dropped,
+        missing hashes are filled in. Returns (checked, dropped)
+        '''
+        checked = dropped = 0
+        with self.lock:
+            rows = self.db.execute('SELECT target, kind, stage, path, size, hash FROM stages').fetchall()
+        for target, kind, stage, fpath, size, sha1 in rows:
+            checked += 1
+            try:
+                ok = os.path.getsize(fpath) == size
+                if ok and sha1 is None:
+                    with self.lock:
+                        self.db.execute('UPDATE stages SET hash = ? WHERE target = ? AND kind = ? AND stage = ?',
+                                        (file_digest(fpath), target, kind, stage))
+                elif ok:
+                    ok = file_digest(fpath) == sha1
+            except OSError:
+                ok = False
+            if not ok:
+                dropped += 1
+                self.logger.info('INFO:: Job index: dropped {} {} {}'.format(kind, stage, fpath))
+                self.forget(target, kind, stage)
+        with self.lock:
+            self.db.commit()
+        return (checked, dropped)
+    #
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+
+class DLInfoCache(object):
+    '''
+    youtube-dl extract_info result per link. Kept in memory, and on disk (one json file per link)
+    when ttl > 0, for ttl seconds but at most MAX_AGE: format urls (e.g. youtube signed urls) expire.
+    '''
+    MAX_AGE = 3 * 3600  # seconds, below the few hours youtube format urls live
+    #
+    def __init__(self, cachefolder, ttl, logger):
+        self.cachefolder = cachefolder
+        self.ttl         = ttl
+        self.max_age     = min(ttl, self.MAX_AGE) if ttl > 0 else self.MAX_AGE
+        self.logger      = logger
+        self.infos       = {}  # link -> (time.time() resolved, info dict)
+        self.locks       = {}  # link -> Lock, so the same link is resolved once
+        self.lock        = threading.Lock()
+        if self.ttl > 0:
+            os.makedirs(self.cachefolder, exist_ok=True)
+    #
+    def link_lock(self, link):
+        with self.lock:
+            return self.locks.setdefault(link, threading.Lock())
+    #
+    def cachefile(self, link):
+        return os.path.join(self.cachefolder, hashlib.sha1(link.encode('utf-8')).hexdigest() + '.json')
+    #
+    def get(self, link):
+        with self.lock:
+            resolved, info = self.infos.get(link, (None, None))
+        if info is not None and time.time() - resolved >= self.max_age:
+            info = None
+        if info is None and self.ttl > 0:
+            try:
+                resolved = os.path.getmtime(self.cachefile(link))
+                if time.time() - resolved < self.max_age:
+                    with open(self.cachefile(link), 'rt') as f:
+                        info = json.load(f)
+                    with self.lock:
+                        self.infos[link] = (resolved, info)
+                    self.logger.debug('DEBUG:: Info cache hit on disk: {}'.format(link))
+            except (OSError, ValueError):
+                pass
+        return info
+    #
+    def put(self, link, info):
+        now = time.time()
+        with self.lock:
+            self.infos[link] = (now, info)
+            # forget expired links, so a long run (daemon) does not keep every link seen
+            for old in [k for k, (resolved, _) in self.infos.items() if now - resolved >= self.max_age]:
+                del self.infos[old]
+            for old in [k for k, lock in self.locks.items() if k not in self.infos and not lock.locked()]:
+                del self.locks[old]
+        if self.ttl > 0:
+            os.makedirs(self.cachefolder, exist_ok=True)
+            tmpfile = self.cachefile(link) + '.tmp'
+            with open(tmpfile, 'wt') as f:
+                json.dump(info, f, default=repr)
+            os.replace(tmpfile, self.cachefile(link))
+    #
+    def drop(self, link):
+        '''
+        Forget the info of link, e.g. after a failed download, so it is resolved again
+        '''
+        with self.lock:
+            self.infos.pop(link, None)
+        if self.ttl > 0:
+            try:
+                os.remove(self.cachefile(link))
+            except OSError:
+                pass
+
+class DLStore(object):
+    '''
+    Content addressed store of downloaded and normalized media, by extractor video id and product
+    (e.g. 'video-mkv', 'audio-mp3-norm'), so a media used by several rows is produced once.
+    Files are <folder>/<extractor>/<video id>/<product>.<ext>
+    '''
+    def __init__(self, folder, logger):
+        self.folder = folder
+        self.logger = logger
+        self.locks  = {}  # (key, product) -> Lock
+        self.lock   = threading.Lock()
+    #
+    def slot(self, key, product):
+        with self.lock:
+            return self.locks.setdefault((key, product), threading.Lock())
+    #
+    def path(self, key, product):
+        '''
+        Stored file of this product, None if not stored yet
+        '''
+        for fpath in glob.glob(os.path.join(glob.escape(os.path.join(self.folder, key)), product + '.*')):
+            if not fpath.endswith('.tmp'):
+                return fpath
+        return None
+    #
+    def add(self, key, product, fpath, hardlink=True):
+        os.makedirs(os.path.join(self.folder, key), exist_ok=True)
+        storefpath = os.path.join(self.folder, key, product + os.path.splitext(fpath)[1])
+        method = place_file(fpath, storefpath, 'auto' if hardlink else 'reflink')
+        self.logger.debug('DEBUG:: Store: added {} ({})'.format(storefpath, method))
+        return storefpath
+    #
+    def fill(self, key, product, fnamenoext, hardlink=True):
+        '''
+        Fill fnamenoext + ext from the store. Returns the filled file, None if not stored
+        '''
+        storefpath = self.path(key, product)
+        if storefpath is None:
+            return None
+        fpath  = fnamenoext + os.path.splitext(storefpath)[1]
+        method = place_file(storefpath, fpath, 'auto' if hardlink else 'reflink')
+        self.logger.info('INFO:: Store: {} filled from {} ({})'.format(fpath, storefpath, method))
+        return fpath
+
+class DLTempManager(object):
+    '''
+    Keeps temporary folders under a byte budget. When over budget, evictable files (as told by
+    evictable(fpath): an eviction tier, None to keep) are removed by tier then least recently
+    used first. Files under a protected prefix (in-flight rows) are never removed.
+    '''
+    def __init__(self, folders, budget, evictable, logger, on_evict=None):
+        self.folders   = folders
+        self.budget    = budget
+        self.evictable = evictable
+        self.logger    = logger
+        self.on_evict  = on_evict   # on_evict(fpath), after removal
+        self.prefixes  = {}         # protected path prefix -> count
+        self.lock      = threading.Lock()  # one eviction at a time
+        self.plock     = threading.Lock()
+        self.used      = 0          # bytes, at last scan
+        self.evicted   = 0          # files, since start
+        self.reclaimed = 0          # bytes, since start
+    #
+    def protect(self, prefix):
+        with self.plock:
+            self.prefixes[prefix] = self.prefixes.get(prefix, 0) + 1
+    #
+    def unprotect(self, prefix):
+        with self.plock:
+            self.prefixes[prefix] -= 1
+            if not self.prefixes[prefix]:
+                del self.prefixes[prefix]
+    #
+    def protected(self, fpath):
+        with self.plock:
+            return any(fpath.startswith(prefix) for prefix in self.prefixes)
+    #
+    def scan(self):
+        '''
+        Files under the folders with their stat, links to each inode seen under the folders, and
+        bytes used (hardlinks counted once). Inodes also linked elsewhere (e.g. a store file
+        hardlinked into the output folder) are not counted: removing them frees nothing.
+        '''
+        files = []
+        links = {}  # (st_dev, st_ino) -> links under the folders
+        for folder in self.folders:
+            for root, _, fnames in os.walk(folder):
+                for fname in fnames:
+                    fpath = os.path.join(root, fname)
+                    try:
+                        st = os.lstat(fpath)
+                    except OSError:
+                        continue
+                    links[(st.st_dev, st.st_ino)] = links.get((st.st_dev, st.st_ino), 0) + 1
+                    files.append((fpath, st))
+        files = [(fpath, st) for fpath, st in files if st.st_nlink <= links[(st.st_dev, st.st_ino)]]
+        used  = sum(st.st_size for fpath, st in {(st.st_dev, st.st_ino): (fpath, st) for fpath, st in files}.values())
+        return files, links, used
+    #
+    def enforce(self):
+        '''
+        Evict until under budget. Returns (files evicted, bytes reclaimed)
+        '''
+        if not self.lock.acquire(blocking=False):
+            return (0, 0)  # already being done by another thread
+        try:
+            files, links, self.used = self.scan()
+            if self.used <= self.budget:
+                return (0, 0)
+            candidates = []
+            for fpath, st in files:
+                tier = self.evictable(fpath)
+                if tier is not None:
+                    candidates.append((tier, max(st.st_atime, st.st_mtime), fpath, st))
+            candidates.sort()
+            evicted = reclaimed = 0
+            for _, _, fpath, st in candidates:
+                if self.used <= self.budget:
+                    break
+                if self.protected(fpath):
+                    continue
+                try:
+                    os.remove(fpath)
+                except OSError:
+                    continue
+                evicted += 1
+                key = (st.st_dev, st.st_ino)
+                links[key] -= 1
+                if not links[key]:  # else the space is still used by another link
+                    reclaimed += st.st_size
+                    self.used -= st.st_size
+                self.logger.debug('DEBUG:: Temp evicted: {} ({} bytes)'.format(fpath, st.st_size))
+                if self.on_evict is not None:
+                    self.on_evict(fpath)
+            self.evicted   += evicted
+            self.reclaimed += reclaimed
+            if evicted:
+                self.logger.info('INFO:: Temp budget: evicted {} files, reclaimed {} bytes, {} of {} bytes used'.format(
+                    evicted, reclaimed, self.used, self.budget))
+            elif self.used > self.budget:
+                self.logger.info('INFO:: Temp budget: {} of {} bytes used, nothing left to evict'.format(self.used, self.budget))
+            return (evicted, reclaimed)
+        finally:
+            self.lock.release()
+
+class DLCoverCache(object):
+    '''
+    Cover art files, each read (and optionally downscaled) once per run and shared by all
+    tracks using it. When maxsize is given, covers larger than maxsize x maxsize pixels are
+    re-encoded by ffmpeg to JPEG fitting in it, the smaller of the original and re-encoded is kept.
+    '''
+    # magic bytes -> mime type
+    MAGIC = ((b'\xff\xd8\xff', 'image/jpeg'),
+             (b'\x89PNG\r\n\x1a\n', 'image/png'),
+             (b'GIF87a', 'image/gif'),
+             (b'GIF89a', 'image/gif'),
+             (b'BM', 'image/bmp'))
+    #
+    def __init__(self, coverfolder, maxsize, logger):
+        self.coverfolder = coverfolder
+        self.maxsize     = maxsize  # pixels, None or 0: as is
+        self.logger      = logger
+        self.covers      = {}       # file name -> (mime, data)
+        self.locks       = {}       # file name -> Lock, so a cover is loaded once
+        self.lock        = threading.Lock()
+    #
+    def mime(self, data):
+        for magic, mime in self.MAGIC:
+            if data.startswith(magic):
+                return mime
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return 'image/webp'
+        return 'image/jpeg'
+    #
+    def get(self, fname):
+        '''
+        Returns (mime, data) of the cover. Raises OSError if it can not be read
+        '''
+        with self.lock:
+            lock = self.locks.setdefault(fname, threading.Lock())
+        with lock:
+            if fname not in self.covers:
+                self.covers[fname] = self.load(os.path.join(self.coverfolder, fname))
+            return self.covers[fname]
+    #
+    def load(self, fpath):
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        mime = self.mime(data)
+        if self.maxsize:
+            scale = "scale='min(iw,{0})':'min(ih,{0})':force_original_aspect_ratio=decrease".format(self.maxsize)
+            cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', fpath,
+                   '-vf', scale, '-frames:v', '1', '-q:v', '2', '-f', 'mjpeg', '-']
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode != 0 or not proc.stdout:
+                self.logger.debug('DEBUG:: Cover {} not re-encoded: {}'.format(fpath, proc.stderr.decode(errors='replace')))
+            elif len(proc.stdout) < len(data):
+                self.logger.debug('DEBUG:: Cover {} re-encoded: {} -> {} bytes'.format(fpath, len(data), len(proc.stdout)))
+                mime, data = 'image/jpeg', proc.stdout
+            else:
+                self.logger.debug('DEBUG:: Cover {} kept as is, re-encoded is not smaller'.format(fpath))
+        self.logger.debug('DEBUG:: Cover {} loaded: {}, {} bytes'.format(fpath, mime, len(data)))
+        return (mime, data)
+
+class DLLeases(object):
+    '''
+    Media claims shared by several nodes working on the same input list, as lease files in a
+    shared folder, one per link. A lease is created exclusively, refreshed (mtime) by a heartbeat
+    while held, and removed when the last row of this node using it is finished. A lease not
+    refreshed for ttl seconds, or held by a dead process of this host, is stale and can be reclaimed.
+    '''
+    def __init__(self, folder, ttl, logger):
+        self.folder  = folder
+        self.ttl     = ttl
+        self.logger  = logger
+        self.host    = socket.gethostname()
+        self.owner   = {'host': self.host, 'pid': os.getpid()}
+        self.held    = {}  # lease file of this node -> rows using it
+        self.lock    = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(self.folder, exist_ok=True)
+        self.heartbeat = threading.Thread(target=self.refresh, name='lease-heartbeat', daemon=True)
+        self.heartbeat.start()
+    #
+    def leasefile(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lease')
+    #
+    def claim(self, key):
+        '''
+        True if this node now holds the lease of key, also when already held for another row
+        '''
+        fpath = self.leasefile(key)
+        with self.lock:
+            if fpath in self.held:
+                self.held[fpath] += 1
+                return True
+        for _ in range(2):
+            try:
+                fd = os.open(fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self.reclaim(fpath):
+                    return False
+                continue
+            with os.fdopen(fd, 'wt') as f:
+                json.dump({**self.owner, 'key': key, 'time': time.time()}, f)
+            with self.lock:
+                self.held[fpath] = self.held.get(fpath, 0) + 1
+            return True
+        return False
+    #
+    @staticmethod
+    def read_lease(fpath):
+        '''
+        (stat, owner) of a lease file, owner {} while being written
+        '''
+        st = os.stat(fpath)
+        try:
+            with open(fpath, 'rt') as f:
+                return (st, json.load(f))
+        except ValueError:
+            return (st, {})
+    #
+    def reclaim(self, fpath):
+        '''
+        Remove fpath if stale. Renamed first, so only one node removes it, then checked to still
+        be the lease judged stale: one claimed again by another node meanwhile is put back
+        '''
+        try:
+            st, owner = self.read_lease(fpath)
+        except FileNotFoundError:
+            return True   # released meanwhile
+        except OSError:
+            return False
+        age = time.time() - st.st_mtime
+        stale = age > self.ttl
+        if not stale and owner.get('host') == self.host and owner.get('pid') != self.owner['pid']:
+            try:
+                os.kill(owner['pid'], 0)
+            except ProcessLookupError:
+                stale = True
+            except (OSError, TypeError, KeyError):
+                pass
+        if not stale:
+            return False
+        stalefile = '{}.stale.{}.{}'.format(fpath, self.host, os.getpid())
+        try:
+            os.rename(fpath, stalefile)
+        except FileNotFoundError:
+            return True   # reclaimed by another node, try to claim it
+        try:
+            renamed, renamed_owner = self.read_lease(stalefile)
+            same = ((renamed.st_ino, renamed.st_mtime_ns) == (st.st_ino, st.st_mtime_ns)
+                    and renamed_owner == owner)
+        except OSError:
+            same = False
+        if not same:
+            # refreshed, or released and claimed again, since it was judged stale
+            try:
+                os.link(stalefile, fpath)
+            except FileExistsError:
+                self.logger.error('ERROR:: Lease of {}:{} taken over meanwhile: {}'.format(
+                    renamed_owner.get('host'), renamed_owner.get('pid'), fpath))
+            os.remove(stalefile)
+            return False
+        os.remove(stalefile)
+        self.logger.info('INFO:: Reclaimed stale lease of {}:{} ({:.0f}s old)'.format(
+            owner.get('host'), owner.get('pid'), age))
+        return True
+    #
+    def release(self, key):
+        fpath = self.leasefile(key)
+        with self.lock:
+            if fpath not in self.held:
+                return
+            self.held[fpath] -= 1
+            if self.held[fpath] > 0:
+                return
+            del self.held[fpath]
+        try:
+            os.remove(fpath)
+        except FileNotFoundError:
+            self.logger.error('ERROR:: Lease lost: {}'.format(key))
+    #
+    def refresh(self):
+        while not self.stopped.wait(max(1, self.ttl / 3)):
+            with self.lock:
+                held = list(self.held)
+            for fpath in held:
+                try:
+                    os.utime(fpath)
+                except FileNotFoundError:
+                    self.logger.error('ERROR:: Lease lost: {}'.format(fpath))
+    #
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        with self.lock:
+            held, self.held = list(self.held), {}
+        for fpath in held:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(fpath)
+
+class DLWatchFolder(object):
+    '''
+    Input csv files dropped into a folder, or appended to, are read from where they were left,
+    complete lines only. Offsets are kept in offsetfile, so a restart does not submit rows again.
+    '''
+    def __init__(self, folder, offsetfile, on_lines, interval, logger):
+        self.folder     = folder
+        self.offsetfile = offsetfile
+        self.on_lines   = on_lines  # on_lines(fpath, lines)
+        self.interval   = interval
+        self.logger     = logger
+        self.offsets    = {}        # fpath -> {'inode', 'offset'}
+        self.stopped    = threading.Event()
+        self.thread     = threading.Thread(target=self.run, name='watch', daemon=True)
+        try:
+            with open(self.offsetfile, 'rt') as f:
+                self.offsets = json.load(f)
+        except (OSError, ValueError):
+            pass
+    #
+    def start(self):
+        self.thread.start()
+    #
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+    #
+    def run(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                self.logger.error('ERROR:: Watch folder {}: {}'.format(self.folder, e))
+            if self.stopped.wait(self.interval):
+                break
+    #
+    def scan(self):
+        for fpath in sorted(glob.glob(os.path.join(glob.escape(self.folder), '*.csv'))):
+            st    = os.stat(fpath)
+            state = self.offsets.get(fpath)
+            # a new file, or replaced, or truncated, is read from the start
+            offset = state['offset'] if state and state['inode'] == st.st_ino and state['offset'] <= st.st_size else 0
+            if offset == st.st_size:
+                continue
+            with open(fpath, 'rb') as f:
+                f.seek(offset)
+                data = f.read(st.st_size - offset)
+            end = data.rfind(b'\n') + 1  # a last line being written is read next time
+            if end == 0:
+                continue
+            self.logger.info('INFO:: Watch folder: reading {} from byte {}'.format(fpath, offset))
+            self.on_lines(fpath, data[:end].decode('utf-8', errors='replace').splitlines())
+            self.offsets[fpath] = {'inode': st.st_ino, 'offset': offset + end}
+            self.save()
+    #
+    def save(self):
+        tmpfile = self.offsetfile + '.tmp'
+        with open(tmpfile, 'wt') as f:
+            json.dump(self.offsets, f, indent=1)
+        os.replace(tmpfile, self.offsetfile)
+
+class DLApiHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Job submission API of the daemon:
+      POST /jobs        input csv rows as request body, returns the accepted jobs at once
+      GET  /jobs        status of the recent jobs
+      GET  /jobs/<id>   status of one job
+      GET  /downloads   progress of the downloads running now
+    '''
+    engine = None  # DLYoutube, set by DLYoutube.api_server
+    #
+    def reply(self, code, obj):
+        body = json.dumps(obj, indent=1).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    #
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/jobs':
+            with self.engine.rows_lock:
+                jobs = list(self.engine.rows.values())
+            self.reply(200, [self.engine.row_status(job) for job in jobs])
+        elif path == '/downloads':
+            self.reply(200, [dict(progress, id=rowid) for rowid, progress in self.engine.downloads()])
+        elif path.startswith('/jobs/') and path[len('/jobs/'):].isdigit():
+            job = self.engine.rows.get(int(path[len('/jobs/'):]))
+            if job is None:
+                self.reply(404, {'error': 'no such job'})
+            else:
+                self.reply(200, self.engine.row_status(job))
+        else:
+            self.reply(404, {'error': 'not found'})
+    #
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': 'not found'})
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        jobs = []
+        for od in self.engine.parse_rows(data.decode('utf-8', errors='replace').splitlines()):
+            # not submitted here: the pipeline queue is bounded, and playlists are expanded by the network
+            job = self.engine.accept_row(od, 'api')
+            jobs.append(self.engine.row_status(job) if job is not None else {'status': 'skipped'})
+        self.reply(202, jobs)
+    #
+    def address_string(self):
+        # no client address on unix socket
+        return self.client_address[0] if self.client_address else 'unix'
+    #
+    def log_message(self, format, *args):
+        self.engine.logger.debug('DEBUG:: API {} {}'.format(self.address_string(), format % args))
+
+class DLTCPHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+class DLUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
 class DLYoutube(object):
     '''
     Download from youtube, normalize and update ID3 tag
@@ -108,18 +1376,95 @@ class DLYoutube(object):
     PICTURE      = 'picture'
     #
     VIDEO_FILE_EXT = ('mp4', 'mkv', 'webm', 'mpg', 'mpeg', 'mpe', 'mpv', 'mp4', 'm4v', 'avi', 'wmv', 'mov')
+    SUBTITLE_FILE_EXT = ('vtt', 'srt', 'ass', 'ttml', 'srv1', 'srv2', 'srv3')
+    # one pass video parts in the store: product, file name suffix (see video_parts)
+    VIDEO_PARTS = (('video-stream', '.fvideo'), ('audio-stream', '.faudio'), ('subtitle-en', '.fvideo.en'))
+    # source audio stream, mp3 last since it is only there when transcoded by youtube-dl
+    AUDIO_FILE_EXT = ('m4a', 'webm', 'opus', 'ogg', 'aac', 'flac', 'wav', 'mp3')
     # this is input csv format sequence
     INPUT_CSV_HEADER = (DLTYPE, DLINK, ALBUMARTIST, ALBUM, TITLE, ARTIST, GENRE, YEAR, PICTURE)
+    ROWS_KEPT        = 10000  # rows kept for status queries
+    # playlist or channel, expanded into rows of type 'a', 'v', 'av'
+    PLAYLIST_DLTYPES = ('pa', 'pv', 'pav')
+    RETRY_MAX_DELAY  = 1800   # seconds, backoff cap
+    TMP_CHECK_INTERVAL = 10   # seconds between temporary folders budget checks
+    # youtube-dl errors which will not go away by retrying
+    PERMANENT_ERRORS = re.compile(r'Unsupported URL|Video unavailable|is not available|private video|'
+                                  r'This video is private|has been removed|copyright|members.only|'
+                                  r'account .* terminated|Sign in to confirm your age|'
+                                  r'HTTP Error (400|401|404|410)', re.IGNORECASE)  # 403: expired url or throttled
     #
     def __init__(self, **kwargs):
         self.inputList        = None
         self.outputFolder     = None
-        self.downloaded_fname = None
         self.logger           = None
         self.verbose          = None
+        self.logListener      = None
+        self.logQueueHandler  = None
         #
         self.convert_to_mkv   = False if not kwargs.get('converttomkv', False) else True
         self.rm_cache_dir     = False if not kwargs.get('rmcachedir', False) else True
+        self.audio_from_video = False if not kwargs.get('audiofromvideo', False) else True
+        self.loudness_cache   = False if not kwargs.get('loudnesscache', False) else True
+        self.single_encode    = False if not kwargs.get('singleencode', False) else True
+        self.loudnorm         = None   # DLLoudnorm, when loudness_cache is used
+        self.one_pass_video   = False if not kwargs.get('onepassvideo', False) else True
+        self.video_loudnorm   = None   # DLLoudnorm of one pass video, the loudness_cache one when used
+        self.use_job_index    = False if not kwargs.get('jobindex', False) else True
+        self.verify_job_index = False if not kwargs.get('verify', False) else True
+        self.jobindex         = None   # DLJobIndex, when use_job_index is used
+        self.dedup            = False if not kwargs.get('dedup', False) else True
+        self.store            = None   # DLStore, when dedup is used
+        self.place_strategy   = kwargs.get('place') or 'auto'  # how downloaded files are placed in output
+        if self.place_strategy not in PLACE_STRATEGIES:
+            raise DLInvalidOption('Invalid placement strategy: {}'.format(self.place_strategy))
+        self.jobs             = max(1, int(kwargs.get('jobs') or 1))      # download workers
+        self.norm_jobs        = max(1, int(kwargs.get('normjobs') or os.cpu_count() or 1))  # normalize workers
+        self.ffmpeg_cores     = max(1, int(kwargs.get('ffmpegcores') or os.cpu_count() or 1))  # cores of ffmpeg processes
+        self.cpu              = None   # DLCpuScheduler
+        self.tag_jobs         = max(1, int(kwargs.get('tagjobs') or 1))   # tag and placement workers
+        self.queue_size       = max(1, int(kwargs.get('queuesize') or 4)) # pending jobs between stages
+        self.host_jobs        = max(1, int(kwargs.get('hostjobs') or 2))  # concurrent downloads per host
+        self.host_slots       = {}                                        # host -> BoundedSemaphore
+        self.host_slots_lock  = threading.Lock()
+        self.host_rate        = max(0.0, float(kwargs.get('hostrate') or 0))    # requests per minute per host, 0: no limit
+        self.host_buckets     = {}                                              # host -> DLTokenBucket
+        self.limit_rate       = parse_bytes(kwargs.get('limitrate'))            # bytes per second per host, None: no limit
+        self.tmp_budget       = parse_bytes(kwargs.get('tmpbudget'))            # bytes of temporary files, None: no limit
+        self.tmpmgr           = None                                            # DLTempManager, when tmp_budget is used
+        self.tmp_checked      = 0                                               # time.monotonic() of last budget check
+        self.retries          = max(0, int(kwargs.get('retries') if kwargs.get('retries') is not None else 3))
+        self.retry_delay_base = max(0.0, float(kwargs.get('retrydelay') if kwargs.get('retrydelay') is not None else 30))
+        self.failed_lock      = threading.Lock()
+        self.progress_interval = max(0.0, float(kwargs.get('progressinterval') if kwargs.get('progressinterval') is not None else 5))
+        self.archive_file     = None                                            # download archive of playlist entries
+        self.archive          = set()                                           # archive keys, loaded by start
+        self.archive_lock     = threading.Lock()
+        self.playlist_end     = kwargs.get('playlistend')                       # last playlist entry expanded, None: all
+        self.flat_opts        = {'extract_flat': 'in_playlist'}
+        if self.playlist_end:
+            self.flat_opts['playlistend'] = int(self.playlist_end)
+        self.info_ttl         = max(0, int(kwargs.get('infottl') or 0))  # seconds, 0: no info cache on disk
+        self.infocache        = None                                     # DLInfoCache
+        self.tls              = threading.local()                        # per thread: job, ydls
+        self.ydls             = []                                       # all YoutubeDL created
+        self.ydls_lock        = threading.Lock()
+        self.extractors       = kwargs.get('extractors') or []              # extra youtube-dl InfoExtractor
+        self.metrics_textfile = kwargs.get('metricstextfile')              # Prometheus textfile collector file
+        self.metrics          = None                                       # DLMetrics
+        self.shard            = self.parse_shard(kwargs.get('shard'))      # (i, N): rows of shard i of N, 1 <= i <= N
+        self.lease_dir        = kwargs.get('leasedir')                     # shared folder of row leases
+        self.lease_ttl        = max(1, int(kwargs.get('leasettl') or 300)) # seconds, lease not refreshed is stale
+        self.leases           = None                                       # DLLeases, when lease_dir is used
+        self.rows_read        = 0                                          # input rows read so far
+        self.rows_skipped     = 0                                          # rows claimed by other nodes
+        self.rows             = {}                                         # row id -> DLJob, latest ROWS_KEPT
+        self.rows_lock        = threading.Lock()
+        self.intake           = queue.Queue()                              # daemon: (od, source, job) accepted, not submitted yet
+        self.pipeline         = None                                       # DLPipeline, set by start
+        self.listen           = kwargs.get('listen')                       # daemon api: host:port or unix socket path
+        self.watch_folder     = kwargs.get('watchfolder')                  # daemon: folder of input csv files
+        self.watch_interval   = max(0.1, float(kwargs.get('watchinterval') or 2))  # seconds between watch folder scans
         #
         self.verbose          = self.set_verbosity(kwargs.get('verbose', logging.NOTSET))  # integer
         #
@@ -134,7 +1479,12 @@ class DLYoutube(object):
         #
         inputlist    = kwargs.get('inputlist')
         try:
-            self.inputList = self.parse_input_list(os.path.abspath(inputlist))
+            if inputlist is None:
+                self.inputList = iter(())  # daemon without input list
+            else:
+                # rows are read lazily by main, check the file can be read now
+                open(os.path.abspath(inputlist), 'rt').close()
+                self.inputList = self.parse_input_list(os.path.abspath(inputlist))
         except FileNotFoundError as e:
             print('Input file not found: {}'.format(e))
             raise
@@ -146,6 +1496,7 @@ class DLYoutube(object):
         self.tempVideoFolder  = os.path.join(self.tempFolder, 'video')
         self.tempAudioFolder  = os.path.join(self.tempFolder, 'audio')
         self.cacheFolder      = os.path.join(self.tempFolder, 'cache') # must contains 'cache' or 'tmp'
+        self.archive_file     = os.path.abspath(kwargs.get('archive') or os.path.join(self.tempFolder, 'archive.txt'))
         # create folders
         for d in (self.tempFolder, self.tempVideoFolder, self.tempAudioFolder, self.cacheFolder):
             try:
@@ -166,31 +1517,106 @@ class DLYoutube(object):
         # output log to console
         consoleHandler = logging.StreamHandler(sys.stdout)
         consoleHandler.setFormatter(formatter)
-        self.logger.addHandler(consoleHandler)
         # output log to file
         now = datetime.datetime.now()
         logFile = os.path.join(self.tempFolder, 'dl-youtube_{}.log'.format(now.strftime('%Y%m%d_%H%M%S')))
         fileHandler = logging.FileHandler(logFile)
         fileHandler.setFormatter(formatter)
-        self.logger.addHandler(fileHandler)
+        # console and file are written by a background thread, logging does not wait for them
+        self.logQueueHandler = logging.handlers.QueueHandler(queue.Queue(-1))
+        self.logListener     = logging.handlers.QueueListener(self.logQueueHandler.queue, consoleHandler, fileHandler)
+        self.logListener.start()
+        self.logger.addHandler(self.logQueueHandler)
+        atexit.register(self.stop_logging)
+        self.covers = DLCoverCache(self.coverFolder, kwargs.get('covermaxsize'), self.logger)
+        # per stage timing and throughput, next to the log file
+        eventFile = os.path.join(self.tempFolder, 'dl-youtube_{}.events.jsonl'.format(now.strftime('%Y%m%d_%H%M%S')))
+        self.metrics = DLMetrics(eventFile, self.metrics_textfile, self.logger)
+        self.cpu     = DLCpuScheduler(self.ffmpeg_cores)
         # check binary executables, etc
         self.logger.info('INFO:: Generated by ' + os.path.basename(__file__) + ' ' + __version__ + ' on ' + now.strftime('%d-%b-%Y %H:%M:%S'))
         self.logger.info('INFO:: Cache folder          : ' + self.cacheFolder)
         self.logger.info('INFO:: Temporary video folder: ' + self.tempVideoFolder)
         self.logger.info('INFO:: Temporary audio folder: ' + self.tempAudioFolder)
         self.logger.info('INFO:: Output folder         : ' + self.outputFolder)
+        self.logger.info('INFO:: Jobs                  : download {} (per host: {}), normalize {}, tag {}, ffmpeg cores {}'.format(
+            self.jobs, self.host_jobs, self.norm_jobs, self.tag_jobs, self.ffmpeg_cores))
+        self.logger.info('INFO:: Metrics events        : ' + eventFile)
+        if self.shard is not None:
+            self.logger.info('INFO:: Shard                 : {} of {}'.format(*self.shard))
+        if self.lease_dir:
+            self.logger.info('INFO:: Lease folder          : {} (ttl {}s)'.format(os.path.abspath(self.lease_dir), self.lease_ttl))
+        #
+        self.ydl_opts = {
+            # 'rm_cachedir'   : True,   # delete by self.rm_cache_dir() before download
+            'verbose'       : True,
+            'cachedir'      : self.cacheFolder,
+            'keepvideo'     : True,
+            'logger'        : self.logger,
+            'noprogress'    : True,
+            'continuedl'    : True,   # resume *.part left by an interrupted run or a failed attempt
+            # downloaders are shared by rows, progress goes to the row of the calling thread
+            'progress_hooks': [lambda d: self.ydl_hook(d, self.tls.job)]
+        }
+        if self.limit_rate:
+            # host cap shared by its concurrent downloads
+            self.ydl_opts['ratelimit'] = max(1, self.limit_rate // self.host_jobs)
     #
     def parse_input_list(self, inputcsvfile):
-        lod = []
+        '''
+        Rows of input csv, read as they are consumed
+        '''
+        with open(inputcsvfile, 'rt') as f:
+            yield from self.parse_rows(f)
+    #
+    def parse_rows(self, lines):
+        '''
+        Input csv lines to rows (dict), without comments and blank lines
+        '''
         def decomment(csvfile):
             for row in csvfile:
                 raw = row.split('#')[0].strip()
                 if raw: yield raw
-        with open(inputcsvfile, 'rt') as f:
-            for od in csv.DictReader(decomment(f), fieldnames=self.INPUT_CSV_HEADER):
-                lod.append(od)
-        #
-        return lod
+        return csv.DictReader(decomment(lines), fieldnames=self.INPUT_CSV_HEADER)
+    #
+    def parse_shard(self, shard):
+        '''
+        'i/N' to (i, N), None when not sharded
+        '''
+        if not shard:
+            return None
+        try:
+            i, n = (int(v) for v in shard.split('/'))
+        except ValueError:
+            raise DLInvalidOption('Invalid shard, expected i/N: {}'.format(shard))
+        if not 1 <= i <= n:
+            raise DLInvalidOption('Invalid shard, expected 1 <= i <= N: {}'.format(shard))
+        return (i, n)
+    #
+    def row_link(self, od):
+        return (od[self.DLINK] or '').strip().strip('"')
+    #
+    def in_shard(self, od):
+        '''
+        Rows are sharded by link, so rows sharing a media are done by the same node
+        '''
+        if self.shard is None:
+            return True
+        i, n = self.shard
+        return int(hashlib.sha1(self.row_link(od).encode('utf-8')).hexdigest(), 16) % n == i - 1
+    #
+    def row_finished(self, job):
+        self.metrics.row_finished(job)
+        self.archive_done(job)
+        if job.status == 'failed':
+            self.record_failure(job)
+        if self.tmpmgr is not None:
+            for prefix in job.protected:
+                self.tmpmgr.unprotect(prefix)
+            job.protected = []
+            self.enforce_tmp_budget()
+        if self.leases is not None:
+            self.leases.release(self.row_link(job.od))
     #
     def set_verbosity(self, verbose):
         """
@@ -225,6 +1651,51 @@ class DLYoutube(object):
         else:
             return None
     #
+    def downloaded_audio_file_exist(self, fnamenoext):
+        for fname in [fnamenoext + '.' + fext for fext in self.AUDIO_FILE_EXT]:
+            if os.path.isfile(fname):
+                return fname
+        else:
+            return None
+    #
+    def find_done(self, job, kind, stage, probe):
+        '''
+        File of a finished stage ('downloaded', 'normalized', 'tagged') of the row's video or audio.
+        Looked up in the job index, else probed on disk by probe() and recorded for next time.
+        '''
+        if self.jobindex is not None:
+            fpath = self.jobindex.get(job.song_fpath, kind, stage)
+            if fpath is not None:
+                return fpath
+        fpath = probe()
+        if fpath is not None and self.jobindex is not None:
+            self.jobindex.record(job.song_fpath, kind, stage, fpath, digest=False)
+        return fpath
+    #
+    def is_done(self, job, kind, stage, fpath):
+        if self.jobindex is not None and self.jobindex.get(job.song_fpath, kind, stage) == fpath:
+            return True
+        if os.path.isfile(fpath):
+            if self.jobindex is not None:
+                self.jobindex.record(job.song_fpath, kind, stage, fpath, digest=False)
+            return True
+        return False
+    #
+    def record_done(self, job, kind, stage, fpath, digest=True):
+        '''
+        digest: as DLJobIndex.record. Files read again by the next stage and then dropped are
+        not hashed, a file placed as is carries the hash of its source
+        '''
+        if self.jobindex is not None:
+            self.jobindex.record(job.song_fpath, kind, stage, fpath, digest)
+    #
+    def done_digest(self, job, kind, stage):
+        return self.jobindex.digest(job.song_fpath, kind, stage) if self.jobindex is not None else None
+    #
+    def forget_done(self, job, kind, stage):
+        if self.jobindex is not None:
+            self.jobindex.forget(job.song_fpath, kind, stage)
+    #
     def get_dl_type(self, opt):
         getaudio = False
         getvideo = False
@@ -240,29 +1711,425 @@ class DLYoutube(object):
         return (getaudio, getvideo)
 
     #
-    def ydl_hook(self, d):
+    def host_slot(self, link):
+        '''
+        Semaphore limiting concurrent downloads from the same host
+        '''
+        host = urlparse(link).hostname or link
+        with self.host_slots_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.host_jobs)
+            return self.host_slots[host]
+
+    #
+    def host_throttle(self, link):
+        '''
+        Wait for the host request rate (--host-rate)
+        '''
+        if not self.host_rate:
+            return
+        host = urlparse(link).hostname or link
+        with self.host_slots_lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = DLTokenBucket(self.host_rate / 60.0, burst=self.host_jobs)
+            bucket = self.host_buckets[host]
+        bucket.acquire()
+    #
+    def retry_delay(self, job, exc):
+        '''
+        Seconds before a failed row runs its stage again, exponential backoff with jitter.
+        None when the error is permanent or retries are exhausted.
+        '''
+        if self.is_permanent(exc):
+            job.failure = 'permanent'
+            return None
+        job.failure = 'transient'
+        if job.attempts >= self.retries:
+            return None
+        job.attempts += 1
+        # format urls of the resolved link may have expired (HTTP 403), resolve it again
+        self.infocache.drop(self.row_link(job.od))
+        delay = min(self.RETRY_MAX_DELAY, self.retry_delay_base * 2 ** (job.attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+    #
+    def is_permanent(self, exc):
+        '''
+        Network and youtube-dl errors are transient, unless youtube-dl says the media is gone.
+        Other errors (ffmpeg, tags, files) are permanent, they would fail again the same way
+        '''
+        transient = False
+        while exc is not None:
+            if self.PERMANENT_ERRORS.search(str(exc)):
+                return True
+            if isinstance(exc, (DLYoutubeDLError, ConnectionError, TimeoutError, socket.timeout)) or \
+               type(exc).__name__ in ('DownloadError', 'ExtractorError', 'YoutubeDLError', 'URLError', 'HTTPError'):
+                transient = True
+            exc = exc.__cause__ or exc.__context__
+        return not transient
+    #
+    def record_failure(self, job):
+        '''
+        Append the failed row to tmp/failed-<transient|permanent>.csv, in input csv format
+        with the reason as comment, so transient failures can be submitted again as is
+        '''
+        line = io.StringIO()
+        csv.writer(line).writerow([job.od.get(k) or '' for k in self.INPUT_CSV_HEADER])
+        reason = re.sub(r'[#\r\n]+', ' ', job.error or '')
+        fpath = os.path.join(self.tempFolder, 'failed-{}.csv'.format(job.failure or 'permanent'))
+        with self.failed_lock, open(fpath, 'at') as f:
+            f.write('{}  # {}\n'.format(line.getvalue().rstrip('\r\n'), reason))
+    #
+    def downloader(self, opts):
+        '''
+        Long lived YoutubeDL for these options, one per thread since YoutubeDL is not thread safe
+        '''
+        key = json.dumps({k: v for k, v in opts.items() if k not in ('outtmpl', 'logger', 'progress_hooks')},
+                         sort_keys=True, default=repr)
+        ydls = self.tls.__dict__.setdefault('ydls', {})
+        if key not in ydls:
+            youtube_dl = need('youtube_dl')
+            if self.extractors:
+                # extra extractors go first, so they win over the generic one
+                ydls[key] = youtube_dl.YoutubeDL(opts, auto_init=False)
+                for ie in self.extractors:
+                    ydls[key].add_info_extractor(ie)
+                ydls[key].add_default_info_extractors()
+            else:
+                ydls[key] = youtube_dl.YoutubeDL(opts)
+            with self.ydls_lock:
+                self.ydls.append(ydls[key])
+        return ydls[key]
+    #
+    def extract_info(self, link):
+        '''
+        Resolve link once, format selection of each stage is done on this cached result
+        '''
+        with self.infocache.link_lock(link):
+            info = self.infocache.get(link)
+            if info is None:
+                self.logger.debug('DEBUG:: Resolving: {}'.format(link))
+                self.host_throttle(link)
+                with self.host_slot(link), self.metrics.span('resolve', link=link) as event:
+                    info = self.downloader(self.ydl_opts).extract_info(link, download=False)
+                    event['extractor'] = info.get('extractor_key')
+                self.infocache.put(link, info)
+        return info
+    #
+    def ydl_download(self, job, opts, threads=None):
+        '''
+        Download with youtube-dl. The host slot is held until the last download is finished,
+        its post processing then holds threads cores instead (see ydl_hook)
+        '''
+        info = self.extract_info(job.dlink)
+        ydl  = self.downloader(opts)
+        ydl.params['outtmpl'] = opts['outtmpl']
+        self.tls.job = job
+        # download and youtube-dl post processing (merge, convert, embed) are told apart
+        # by the time of the last finished download
+        event = {'link': job.dlink, 'format': opts.get('format')}
+        job.downloaded_bytes = 0
+        job.downloaded_time  = None
+        ppusage = {}
+        self.tls.postprocess = {'threads'  : threads,
+                                'downloads': len(re.split(r'[+,]', opts.get('format') or '')),
+                                'usage'    : ppusage,
+                                'host'     : contextlib.ExitStack(),
+                                'slot'     : contextlib.ExitStack()}
+        start = time.monotonic()
+        try:
+            self.host_throttle(job.dlink)
+            self.tls.postprocess['host'].enter_context(self.host_slot(job.dlink))
+            with self.tls.postprocess['host'], self.tls.postprocess['slot']:
+                # process_ie_result modifies info, keep the cached one as is. Formats are selected
+                # again by opts, the ones selected when resolving must not be merged instead
+                info = copy.deepcopy(info)
+                info.pop('requested_formats', None)
+                ydl.process_ie_result(info, download=True)
+        except Exception as e:
+            self.metrics.record('download', {**event, 'outcome': 'error', 'error': str(e),
+                                             'seconds': round(time.monotonic() - start, 3)})
+            # its format urls may have expired, a retry resolves the link again
+            self.infocache.drop(job.dlink)
+            raise
+        end = time.monotonic()
+        finished = job.downloaded_time or end
+        self.metrics.record('download', {**event, 'outcome': 'ok', 'bytes': job.downloaded_bytes,
+                                         'seconds': round(finished - start, 3)})
+        if opts.get('postprocessors') or '+' in (opts.get('format') or ''):
+            self.metrics.record('postprocess', {**event, **ppusage, 'outcome': 'ok', 'seconds': round(end - finished, 3),
+                                                'bytes': os.path.getsize(job.downloaded_fname)
+                                                         if job.downloaded_fname and os.path.isfile(job.downloaded_fname) else 0})
+    #
+    def ydl_hook(self, d, job):
+        '''
+        youtube-dl progress, kept in job.progress. Called many times per second per download,
+        so it is logged at most every progress_interval seconds
+        '''
+        job.progress = {'status'          : d['status'],
+                        'filename'        : d.get('filename'),
+                        'downloaded_bytes': d.get('downloaded_bytes'),
+                        'total_bytes'     : d.get('total_bytes') or d.get('total_bytes_estimate'),
+                        'speed'           : d.get('speed'),
+                        'eta'             : d.get('eta')}
         if d['status'] == 'finished':
-            self.downloaded_fname = '{}'.format(d['filename'])
-            msg = 'Downloaded {}'.format(self.downloaded_fname)
+            job.downloaded_fname = '{}'.format(d['filename'])
+            job.downloaded_bytes += d.get('downloaded_bytes') or d.get('total_bytes') or 0
+            job.downloaded_time  = time.monotonic()
+            msg = 'Downloaded {}'.format(job.downloaded_fname)
             if 'downloaded_bytes' in d:
                 msg += ' size: {} bytes'.format(d['downloaded_bytes'])
             #
             self.logger.info('INFO:: ' + msg)
+            # youtube-dl post processing (ffmpeg) starts after the last download of the format,
+            # the host is free for the next download then
+            pp = getattr(self.tls, 'postprocess', None)
+            if pp is not None:
+                pp['downloads'] -= 1
+                if pp['downloads'] == 0:
+                    pp['host'].close()
+                    if pp['threads']:
+                        pp['slot'].enter_context(self.cpu.slot(pp['threads'], pp['usage']))
         elif d['status'] == 'downloading':
-            self.logger.debug('DEBUG:: Downloading {}, ETA: {} seconds'.format(d['filename'], d['eta']))
+            now = time.monotonic()
+            if now - job.progress_logged >= self.progress_interval and self.logger.isEnabledFor(logging.DEBUG):
+                job.progress_logged = now
+                self.logger.debug('DEBUG:: Downloading {}, {} of {} bytes, {} bytes/s, ETA: {} seconds'.format(
+                    d['filename'], d.get('downloaded_bytes'), job.progress['total_bytes'],
+                    int(d['speed']) if d.get('speed') else None, d.get('eta')))
         elif d['status'] == 'error':
             self.logger.error('ERROR::')
     #
+    def downloads(self):
+        '''
+        Progress of the rows downloading now: [(row id, progress dict)]
+        '''
+        with self.rows_lock:
+            jobs = list(self.rows.values())
+        return [(job.rowid, job.progress) for job in jobs
+                if job.status == 'download' and job.progress and job.progress['status'] == 'downloading']
+    #
+    def stop_logging(self):
+        '''
+        Write the queued log records and stop the log writer thread
+        '''
+        if self.logListener is not None:
+            self.logListener.stop()
+            self.logger.removeHandler(self.logQueueHandler)
+            for handler in self.logListener.handlers:
+                handler.close()
+            self.logListener = None
+    #
     def main(self):
-        ydl_opts = {
-            # 'rm_cachedir'   : True,   # delete by self.rm_cache_dir() before download
-            'verbose'       : True,
-            'cachedir'      : self.cacheFolder,
-            'keepvideo'     : True,
-            'logger'        : self.logger,
-            'noprogress'    : True,
-            'progress_hooks': [self.ydl_hook]
-        }
+        '''
+        Process the input list, then stop
+        '''
+        self.start()
+        try:
+            for od in self.inputList:
+                self.submit_row(od)
+        finally:
+            self.finish()
+    #
+    def daemon(self):
+        '''
+        Keep the engine running, taking rows from the input list, the api (listen)
+        and the watch folder, until SIGINT or SIGTERM
+        '''
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop.set())
+        self.start()
+        server  = None
+        watcher = None
+        feeder  = threading.Thread(target=self.feed_intake, name='intake', daemon=True)
+        feeder.start()
+        try:
+            if self.listen:
+                server = self.api_server(self.listen)
+                threading.Thread(target=server.serve_forever, name='api', daemon=True).start()
+            if self.watch_folder:
+                watcher = DLWatchFolder(os.path.abspath(self.watch_folder), os.path.join(self.tempFolder, 'watch.json'),
+                                        self.submit_lines,
+                                        self.watch_interval, self.logger)
+                watcher.start()
+                self.logger.info('INFO:: Daemon: watching {}'.format(os.path.abspath(self.watch_folder)))
+            for od in self.inputList:
+                if stop.is_set():
+                    break
+                self.submit_row(od, 'input')
+            while not stop.wait(1):
+                pass
+            self.logger.info('INFO:: Daemon: stopping, waiting for submitted rows ...')
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                if isinstance(server, DLUnixHTTPServer):
+                    with contextlib.suppress(OSError):
+                        os.remove(self.listen)
+            if watcher is not None:
+                watcher.stop()
+            # rows accepted by the api are submitted before the pipeline is joined
+            self.intake.put(None)
+            feeder.join()
+            self.finish()
+    #
+    def api_server(self, listen):
+        '''
+        HTTP server of DLApiHandler on host:port, or on a unix socket when listen is a path
+        '''
+        handler = type('Handler', (DLApiHandler,), {'engine': self})
+        host, sep, port = listen.rpartition(':')
+        if sep and port.isdigit() and '/' not in listen:
+            server = DLTCPHTTPServer((host or '127.0.0.1', int(port)), handler)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(listen)  # left by a previous run
+            server = DLUnixHTTPServer(listen, handler)
+        self.logger.info('INFO:: Daemon: api on {}'.format(listen))
+        return server
+    #
+    def plan(self):
+        '''
+        Print the download, normalize and tag steps each row would run, by the same skip
+        checks as the stages, without running them nor importing the media stack
+        '''
+        if self.use_job_index:
+            # a dry run, probed files are not written to the index
+            self.jobindex = DLJobIndex(os.path.join(self.tempFolder, 'jobs.sqlite'), self.logger, readonly=True)
+        counts = {}
+        rows   = 0
+        for rowid, od in enumerate(self.inputList, 1):
+            if not self.in_shard(od):
+                continue
+            if self.is_playlist_row(od):
+                # expanding needs youtube-dl and the network
+                print('{:>5} {:<3} {}: playlist, entries are listed when run'.format(rowid, od[self.DLTYPE].strip(), self.row_link(od)))
+                counts['playlist'] = counts.get('playlist', 0) + 1
+                continue
+            rows += 1
+            job = DLJob(od, rowid)
+            self.prepare_job(job, makedirs=False)
+            steps = self.plan_job(job)
+            for kind_steps in steps.values():
+                for step in kind_steps:
+                    counts[step] = counts.get(step, 0) + 1
+            if not any(steps.values()):
+                counts['done'] = counts.get('done', 0) + 1
+            print('{:>5} {:<2} {}: {}'.format(rowid, od[self.DLTYPE].strip().strip('"'), job.song,
+                  '; '.join('{}: {}'.format(kind, ', '.join(kind_steps) or 'done') for kind, kind_steps in steps.items())
+                  or 'nothing to do'))
+        if self.jobindex is not None:
+            self.jobindex.close()
+        print('Plan: {} rows, {} downloads, {} audio extractions, {} normalizations, {} remuxes, {} placements, {} tags, {} rows done'.format(
+              rows, *(counts.get(step, 0) for step in ('download', 'extract', 'normalize', 'remux', 'place', 'tag', 'done'))))
+        if counts.get('playlist'):
+            print('Plan: {} playlist rows not counted, entries not in download archive are run'.format(counts['playlist']))
+        if self.dedup:
+            print('Plan: with --dedup, rows sharing a media download and normalize it once, counted once per row here')
+        return counts
+    #
+    def plan_job(self, job):
+        '''
+        Steps of the row by kind ('video', 'audio'), mirroring stage_download, stage_normalize and stage_tag
+        '''
+        steps = {}
+        if job.getvideo:
+            videofpath    = self.find_done(job, 'video', 'tagged',
+                                           lambda: self.downloaded_video_file_exist(job.song_fpath))
+            steps['video'] = []
+            if videofpath is None:
+                videotmpfpath = self.downloaded_video(job)
+                if videotmpfpath is None:
+                    steps['video'].append('download')
+                if job.isyoutube:
+                    ext = '.mkv' if job.converttomkv else os.path.splitext(videotmpfpath or '')[1]
+                    if not ext or not self.is_done(job, 'video', 'normalized', self.norm_fpath(job, ext)):
+                        steps['video'].append('remux' if job.onepass else 'normalize')
+                steps['video'].append('place')
+        if job.getaudio and job.isyoutube:
+            steps['audio'] = []
+            if not self.is_done(job, 'audio', 'tagged', job.song_fpath + '.mp3'):
+                if self.single_encode:
+                    downloaded = self.find_done(job, 'audio', 'downloaded',
+                                                lambda: self.downloaded_audio_file_exist(job.audio_tmp_fpath)) is not None
+                else:
+                    downloaded = self.is_done(job, 'audio', 'downloaded', job.audio_tmp_fpath + '.mp3')
+                if not downloaded:
+                    if not (self.audio_from_video and job.getvideo):
+                        steps['audio'].append('download')
+                    elif not self.single_encode:
+                        steps['audio'].append('extract')
+                if not self.is_done(job, 'audio', 'normalized', self.norm_fpath(job, '.mp3')):
+                    steps['audio'].append('normalize')
+                steps['audio'].append('tag')
+        return steps
+    #
+    def protect_tmp(self, job, prefix):
+        '''
+        Keep the temporary files of an in-flight row from eviction, until the row is finished
+        '''
+        if self.tmpmgr is not None and prefix not in job.protected:
+            job.protected.append(prefix)
+            self.tmpmgr.protect(prefix)
+    #
+    def tmp_evictable(self, fpath):
+        '''
+        Eviction tier of a temporary file, None to keep it. 0: intermediate of a row whose
+        output is in place, or a resolved link info. 1: store, it may be used by later rows
+        '''
+        for folder, kind in ((self.tempVideoFolder, 'video'), (self.tempAudioFolder, 'audio')):
+            if fpath.startswith(folder + os.sep):
+                # tmp/<kind>/<albumartist>/<album>/<song>.* is for output/<albumartist>/<album>/<song>.*
+                rel = os.path.relpath(fpath, folder)
+                song_fpath = os.path.join(self.outputFolder, os.path.dirname(rel), os.path.basename(rel).split('.')[0])
+                if kind == 'video':
+                    done = self.downloaded_video_file_exist(song_fpath) is not None
+                else:
+                    done = os.path.isfile(song_fpath + '.mp3')
+                return 0 if done else None
+        if fpath.startswith(os.path.join(self.cacheFolder, 'info') + os.sep):
+            return 0
+        if fpath.startswith(os.path.join(self.tempFolder, 'store') + os.sep):
+            return 1
+        return None
+    #
+    def tmp_evicted(self, fpath):
+        if self.jobindex is not None:
+            self.jobindex.forget_path(fpath)
+    #
+    def enforce_tmp_budget(self, force=False):
+        '''
+        Evict temporary files when over budget, checked at most every TMP_CHECK_INTERVAL seconds
+        '''
+        now = time.monotonic()
+        if self.tmpmgr is None or (not force and now - self.tmp_checked < self.TMP_CHECK_INTERVAL):
+            return
+        self.tmp_checked = now
+        files, reclaimed = self.tmpmgr.enforce()
+        if files:
+            self.metrics.record('evict', {'outcome': 'ok', 'seconds': round(time.monotonic() - now, 3),
+                                          'files': files, 'bytes': reclaimed})
+    #
+    def row_status(self, job):
+        od = job.od
+        return {'id'    : job.rowid,
+                'status': job.status,
+                'source': job.source,
+                'type'  : (od[self.DLTYPE] or '').strip().strip('"'),
+                'link'  : self.row_link(od),
+                'song'  : (od[self.TITLE] or '').strip().strip('"'),
+                'error' : job.error,
+                'retries': job.attempts,
+                'progress': job.progress,
+                'failure': job.failure if job.status == 'failed' else None}
+    #
+    def start(self):
+        '''
+        Set up the engine and start its pipeline, rows are then taken by submit_row
+        '''
+        check_requirements()
+        self.load_archive()
         #
         if self.rm_cache_dir:
             if os.path.isdir(self.cacheFolder):
@@ -272,259 +2139,1011 @@ class DLYoutube(object):
             else:
                 self.logger.debug('DEBUG:: Not removing cache folder: {}. It does not exist!!'.format(self.cacheFolder))
 
+        # after the cache folder removal, which would take the info folder with it
+        self.infocache = DLInfoCache(os.path.join(self.cacheFolder, 'info'), self.info_ttl, self.logger)
+        #
+        if self.loudness_cache:
+            # not in self.cacheFolder, --rm-cache-dir is for the youtube-dl cache only
+            self.loudnorm = DLLoudnorm(os.path.join(self.tempFolder, 'loudness.json'), self.logger, self.metrics, self.cpu)
+        if self.one_pass_video:
+            self.video_loudnorm = self.loudnorm or DLLoudnorm(None, self.logger, self.metrics, self.cpu)
+        #
+        if self.use_job_index or self.verify_job_index:
+            self.jobindex = DLJobIndex(os.path.join(self.tempFolder, 'jobs.sqlite'), self.logger)
+            if self.verify_job_index:
+                self.logger.info('INFO:: Job index: verifying ...')
+                self.logger.info('INFO:: Job index: {} records checked, {} dropped'.format(*self.jobindex.verify()))
+        #
+        if self.dedup:
+            self.store = DLStore(os.path.join(self.tempFolder, 'store'), self.logger)
         #
-        for od in self.inputList:
-            dlink         = od[self.DLINK].strip().strip('"')       # download link
-            albumartist   = od[self.ALBUMARTIST].strip().strip('"') # album artist
-            album         = od[self.ALBUM].strip().strip('"')       # album name
-            song          = od[self.TITLE].strip().strip('"')       # song name
-            artist        = od[self.ARTIST].strip().strip('"')      # artist
-            genre         = od[self.GENRE].strip().strip('"')       # genre
-            # date          = od[self.DATE].strip().strip('"')      # year
-            year          = od[self.YEAR].strip().strip('"')        # year
-            cover         = od[self.PICTURE].strip().strip('"')     # cover picture
-
-            # get download type
-            getaudio, getvideo = self.get_dl_type(od[self.DLTYPE].strip().strip('"'))
-            # non-alphanumeric change to underscore
-            albumartist_fname = re.sub('[^0-9a-zA-Z]+', '_', albumartist)
-            # albumartist_fpath: output/albumartist_fname/
-            albumartist_fpath = os.path.join(self.outputFolder, albumartist_fname)
-            album_fname  = re.sub('[^0-9a-zA-Z]+', '_', album)
-            # album_fpath:       output/albumartist_fname/album_fname/
-            album_fpath  = os.path.join(albumartist_fpath, album_fname)
-            song_fname   = re.sub('[^0-9a-zA-Z]+', '_', song)       # title           (without file ext)
-            song_fpath   = os.path.join(album_fpath, song_fname)    # title full path (without file ext)
+        if self.tmp_budget is not None:
+            self.tmpmgr = DLTempManager([self.tempVideoFolder, self.tempAudioFolder, os.path.join(self.tempFolder, 'store'),
+                                         os.path.join(self.cacheFolder, 'info')],
+                                        self.tmp_budget, self.tmp_evictable, self.logger, on_evict=self.tmp_evicted)
+            self.enforce_tmp_budget(force=True)
+        #
+        self.pipeline = DLPipeline([('download' , self.stage_download , self.jobs),
+                                    ('normalize', self.stage_normalize, self.norm_jobs),
+                                    ('tag'      , self.stage_tag      , self.tag_jobs)],
+                                   queuesize=self.queue_size, logger=self.logger,
+                                   on_finish=self.row_finished, retry=self.retry_delay)
+        if self.lease_dir:
+            self.leases = DLLeases(os.path.abspath(self.lease_dir), self.lease_ttl, self.logger)
+        self.pipeline.start()
+    #
+    def submit_row(self, od, source=None, job=None):
+        '''
+        Queue an input csv row (dict), a playlist row as its entries not in the download archive.
+        Returns the jobs, none for a row of another node. Blocks while the pipeline is full.
+        job: the row job given out already by accept_row, or the playlist row job when its
+        expansion is retried
+        '''
+        if not self.in_shard(od):
+            with self.rows_lock:
+                self.rows_read += 1
+            return []
+        if self.is_playlist_row(od):
+            try:
+                entries = list(self.expand_playlist(od))
+            except Exception as e:
+                return self.fail_row(od, source, e, job)
+            if job is not None:
+                job.status = 'done'
+            return [job for entry in entries
+                    for job in (self.fail_row(entry, source, DLInvalidOption(entry['_error'])) if '_error' in entry
+                                else self.submit_one(entry, source))]
+        return self.submit_one(od, source, job)
+    #
+    def submit_one(self, od, source, job=None):
+        if job is None:
+            with self.rows_lock:
+                self.rows_read += 1
+                rowid = self.rows_read
+        else:
+            rowid = job.rowid
+        # leased by link, like --shard, so rows sharing a media are done by the same node
+        if self.leases is not None and not self.leases.claim(self.row_link(od)):
+            self.logger.info('INFO:: Skip row {}: its link is claimed by another node'.format(rowid))
+            self.rows_skipped += 1
+            if job is not None:
+                job.status = 'skipped'
+            return []
+        if job is None:
+            job = self.add_row(od, rowid, source)
+        self.pipeline.submit(job)
+        return [job]
+    #
+    def accept_row(self, od, source):
+        '''
+        Give a row its job at once and queue it to the unbounded intake, submitted by
+        feed_intake. Returns the job, None for a row of another shard
+        '''
+        with self.rows_lock:
+            self.rows_read += 1
+            rowid = self.rows_read
+        if not self.in_shard(od):
+            return None
+        job = self.add_row(od, rowid, source)
+        self.intake.put((od, source, job))
+        return job
+    #
+    def feed_intake(self):
+        '''
+        Submit the rows of the intake to the pipeline, until None is taken
+        '''
+        while True:
+            item = self.intake.get()
+            if item is None:
+                break
+            od, source, job = item
+            try:
+                self.submit_row(od, source, job)
+            except Exception as e:
+                self.fail_row(od, source, e, job)
+    #
+    def add_row(self, od, rowid, source):
+        job = DLJob(od, rowid)
+        job.source = source
+        with self.rows_lock:
+            self.rows[rowid] = job
+            # forget oldest finished rows, the row table must not grow forever in daemon mode
+            if len(self.rows) > self.ROWS_KEPT:
+                for oldid in [k for k, v in self.rows.items() if v.status in ('done', 'failed', 'skipped')][:len(self.rows) - self.ROWS_KEPT]:
+                    del self.rows[oldid]
+        return job
+    #
+    def fail_row(self, od, source, exc, job=None):
+        '''
+        A row failing before the pipeline (playlist expansion, playlist entry template) is
+        submitted again after retry_delay, or finished as failed like the pipeline rows.
+        job: the row job of a previous attempt
+        '''
+        if job is None:
+            with self.rows_lock:
+                self.rows_read += 1
+                rowid = self.rows_read
+            job = self.add_row(od, rowid, source)
+        job.error = str(exc)
+        self.logger.error('ERROR:: {}'.format(exc))
+        delay = self.retry_delay(job, exc)
+        if delay is None:
+            job.status = 'failed'
+            self.row_finished(job)
+            return [job]
+        job.status = 'retrying'
+        self.logger.info('INFO:: Retrying row {} in {:.0f}s (retry {})'.format(job.rowid, delay, job.attempts))
+        self.pipeline.defer(delay, self.submit_row, od, source, job)
+        return [job]
+    #
+    def is_playlist_row(self, od):
+        return (od[self.DLTYPE] or '').strip().strip('"').lower() in self.PLAYLIST_DLTYPES
+    #
+    def expand_playlist(self, od, link=None, depth=0, archive=True):
+        '''
+        Rows of the entries of a playlist or channel row, by flat extraction (one request per
+        playlist, entries are not resolved). Empty columns are filled from the playlist and the
+        entry, and columns may use youtube-dl output template fields, e.g. '%(playlist_index)s %(title)s'.
+        Entries in the download archive are left out. An entry whose columns cannot be formatted
+        is given with its columns as is and the reason in '_error'.
+        '''
+        link = link or self.row_link(od)
+        self.host_throttle(link)
+        try:
+            with self.host_slot(link), self.metrics.span('expand', link=link) as event:
+                info = self.downloader({**self.ydl_opts, **self.flat_opts}).extract_info(link, download=False)
+                event['entries'] = len(info.get('entries') or [])
+        except Exception as e:
+            raise DLYoutubeDLError('Expanding playlist {} failed: {}'.format(link, e)) from e
+        skipped = 0
+        for index, entry in enumerate(info.get('entries') or [], 1):
+            if not entry:
+                continue
+            # a channel may list its playlists (tabs) instead of videos
+            ie_key = entry.get('ie_key') or ''
+            if entry.get('_type') == 'playlist' or (ie_key.endswith(('Tab', 'Playlist')) and depth < 2):
+                yield from self.expand_playlist(od, entry.get('webpage_url') or entry.get('url'), depth + 1, archive)
+                continue
+            try:
+                row = self.playlist_entry_row(od, info, entry, index)
+            except (ValueError, TypeError) as e:
+                row = self.playlist_entry_row(od, info, entry, index, template=False)
+                row['_error'] = 'Playlist {} entry {}: invalid column template: {}'.format(link, index, e)
+                yield row
+                continue
+            if archive and row['_archive'] in self.archive:
+                skipped += 1
+                continue
+            yield row
+        self.logger.info('INFO:: Playlist {}: {} entries, {} already in download archive'.format(
+            info.get('title') or link, len(info.get('entries') or []), skipped))
+    #
+    def playlist_entry_row(self, od, info, entry, index, template=True):
+        '''
+        Input csv row of a playlist entry. Columns with '%(' are youtube-dl output templates,
+        unless not template. Raises ValueError or TypeError on an invalid template
+        '''
+        url = entry.get('webpage_url') or entry.get('url') or entry.get('id')
+        if not re.match(r'^https?://', url or ''):
+            # youtube flat entries have the video id as url
+            url = 'https://www.youtube.com/watch?v=' + (entry.get('id') or url)
+        fields = DLTemplateFields({**{k: v for k, v in entry.items() if not isinstance(v, (dict, list))},
+                                    'playlist'         : info.get('title'),
+                                    'playlist_title'   : info.get('title'),
+                                    'playlist_id'      : info.get('id'),
+                                    'playlist_uploader': info.get('uploader'),
+                                    'playlist_index'   : index})
+        def column(value):
+            value = (value or '').strip().strip('"')
+            if template and '%(' in value:
+                # a literal '%' next to template fields, e.g. '100% Hits %(playlist)s'
+                value = re.sub(r'%%|%(?!\()', '%%', value) % fields
+            return value
+        row = {k: column(od[k]) for k in self.INPUT_CSV_HEADER}
+        row[self.DLTYPE]      = row[self.DLTYPE][1:]  # 'pav' -> 'av'
+        row[self.DLINK]       = url
+        row[self.ALBUMARTIST] = row[self.ALBUMARTIST] or info.get('uploader') or entry.get('uploader') or 'NA'
+        row[self.ALBUM]       = row[self.ALBUM] or info.get('title') or 'NA'
+        row[self.TITLE]       = row[self.TITLE] or entry.get('title') or entry.get('id') or 'NA'
+        row[self.ARTIST]      = row[self.ARTIST] or entry.get('uploader') or row[self.ALBUMARTIST]
+        # download archive key: the entry for this download type and album
+        row['_archive'] = '{} {} {} {}/{}'.format((entry.get('ie_key') or info.get('extractor_key') or 'generic').lower(),
+                                                  entry.get('id') or url, row[self.DLTYPE],
+                                                  re.sub('[^0-9a-zA-Z]+', '_', row[self.ALBUMARTIST]),
+                                                  re.sub('[^0-9a-zA-Z]+', '_', row[self.ALBUM]))
+        return row
+    #
+    def load_archive(self):
+        try:
+            with open(self.archive_file, 'rt') as f:
+                self.archive = set(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            self.archive = set()
+    #
+    def archive_done(self, job):
+        '''
+        Record a playlist entry as done in the download archive, so the next sync skips it
+        '''
+        key = job.od.get('_archive')
+        if key is None or job.status != 'done':
+            return
+        with self.archive_lock:
+            if key in self.archive:
+                return
+            self.archive.add(key)
+            with open(self.archive_file, 'at') as f:
+                f.write(key + '\n')
+    #
+    def submit_lines(self, source, lines):
+        '''
+        Queue the rows of input csv lines
+        '''
+        for od in self.parse_rows(lines):
+            self.submit_row(od, source)
+    #
+    def finish(self):
+        '''
+        Wait for submitted rows and release the engine resources
+        '''
+        try:
+            self.pipeline.join()
+        finally:
+            if self.leases is not None:
+                self.leases.close()
+        if self.rows_skipped:
+            self.logger.info('INFO:: {} rows skipped, claimed by other nodes'.format(self.rows_skipped))
+        if self.tmpmgr is not None:
+            self.enforce_tmp_budget(force=True)
+            self.logger.info('INFO:: Temp budget: {} files evicted, {} bytes reclaimed, {} of {} bytes used'.format(
+                self.tmpmgr.evicted, self.tmpmgr.reclaimed, self.tmpmgr.used, self.tmpmgr.budget))
+        #
+        for ydl in self.ydls:
+            ydl.__exit__(None, None, None)
+        if self.jobindex is not None:
+            self.jobindex.close()
+        if self.loudnorm is not None:
+            self.logger.info('INFO:: Loudness cache: {} hits, {} misses'.format(self.loudnorm.hits, self.loudnorm.misses))
+        self.metrics.close()
+        for stage, outcomes in self.metrics.summary().items():
+            for outcome, stat in outcomes.items():
+                self.logger.info('INFO:: Metrics: {:<16} {:<5} {:>4} calls {:>9.1f}s {:>12} bytes {:>9.1f}s cpu'.format(
+                    stage, outcome, stat['count'], stat['seconds'], stat['bytes'], stat['cpu']))
+    #
+    def prepare_job(self, job, makedirs=True):
+        '''
+        Parse csv row into job fields and create its folders
+        '''
+        od            = job.od
+        job.dlink       = od[self.DLINK].strip().strip('"')       # download link
+        job.albumartist = od[self.ALBUMARTIST].strip().strip('"') # album artist
+        job.album       = od[self.ALBUM].strip().strip('"')       # album name
+        job.song        = od[self.TITLE].strip().strip('"')       # song name
+        job.artist      = od[self.ARTIST].strip().strip('"')      # artist
+        job.genre       = od[self.GENRE].strip().strip('"')       # genre
+        # job.date        = od[self.DATE].strip().strip('"')      # year
+        job.year        = od[self.YEAR].strip().strip('"')        # year
+        job.cover       = od[self.PICTURE].strip().strip('"')     # cover picture
+
+        # get download type
+        job.getaudio, job.getvideo = self.get_dl_type(od[self.DLTYPE].strip().strip('"'))
+        # non-alphanumeric change to underscore
+        albumartist_fname = re.sub('[^0-9a-zA-Z]+', '_', job.albumartist)
+        # albumartist_fpath: output/albumartist_fname/
+        albumartist_fpath = os.path.join(self.outputFolder, albumartist_fname)
+        album_fname  = re.sub('[^0-9a-zA-Z]+', '_', job.album)
+        # album_fpath:       output/albumartist_fname/album_fname/
+        album_fpath  = os.path.join(albumartist_fpath, album_fname)
+        song_fname   = re.sub('[^0-9a-zA-Z]+', '_', job.song)   # title           (without file ext)
+        job.song_fpath = os.path.join(album_fpath, song_fname)  # title full path (without file ext)
+        #
+        audio_tmp_albumartist_fpath = os.path.join(self.tempAudioFolder, albumartist_fname)  # folder
+        audio_tmp_album_fpath       = os.path.join(audio_tmp_albumartist_fpath, album_fname) # folder
+        job.audio_tmp_fpath         = os.path.join(audio_tmp_album_fpath, song_fname)        # filename, not folder
+        video_tmp_albumartist_fpath = os.path.join(self.tempVideoFolder, albumartist_fname)  # folder
+        video_tmp_album_fpath       = os.path.join(video_tmp_albumartist_fpath, album_fname) # folder
+        job.video_tmp_fpath         = os.path.join(video_tmp_album_fpath, song_fname)        # filename, not folder
+        #
+        for d in (video_tmp_albumartist_fpath, video_tmp_album_fpath,
+                  audio_tmp_albumartist_fpath, audio_tmp_album_fpath,
+                  albumartist_fpath, album_fpath) if makedirs else ():
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    continue
+        #
+        job.isyoutube = self.isYoutubeLink(job.dlink)
+        if self.convert_to_mkv is True or job.isyoutube is True:
+            job.converttomkv = True
+        else:
+            job.converttomkv = False
+        # youtube video and audio streams downloaded apart, merged and normalized in one remux
+        job.onepass = self.one_pass_video and job.isyoutube
+    #
+    def stage_download(self, job):
+        '''
+        Stage 1 (network bound): download video and/or audio into temporary folder
+        '''
+        self.metrics.set_job(job)
+        self.prepare_job(job)
+        self.protect_tmp(job, job.video_tmp_fpath + '.')
+        self.protect_tmp(job, job.audio_tmp_fpath + '.')
+        # VIDEO (including it's audio, of course)
+        job.downloaded_fname = None
+        if job.getvideo:
+            self.logger.info('')
+            self.logger.info('INFO:: Processing Video "{}"'.format(job.song))
+            # best guest if we already have target normalized video file
+            videofpath    = self.find_done(job, 'video', 'tagged',
+                                           lambda: self.downloaded_video_file_exist(job.song_fpath))
             #
-            audio_tmp_albumartist_fpath = os.path.join(self.tempAudioFolder, albumartist_fname)  # folder
-            audio_tmp_album_fpath       = os.path.join(audio_tmp_albumartist_fpath, album_fname) # folder
-            audio_tmp_fpath             = os.path.join(audio_tmp_album_fpath, song_fname)        # folder
-            video_tmp_albumartist_fpath = os.path.join(self.tempVideoFolder, albumartist_fname)  # folder
-            video_tmp_album_fpath       = os.path.join(video_tmp_albumartist_fpath, album_fname) # filename, not folder
-            video_tmp_fpath             = os.path.join(video_tmp_album_fpath, song_fname)        # filename, not folder
+            # 1. Download video. Input: youtube link, output: file in videotmpfpath folder
             #
-            for d in (video_tmp_albumartist_fpath, video_tmp_album_fpath,
-                      audio_tmp_albumartist_fpath, audio_tmp_album_fpath,
-                      albumartist_fpath, album_fpath):
-                try:
-                    os.makedirs(d)
-                except OSError:
-                    if not os.path.isdir(d):
-                        continue
+            if videofpath is not None:
+                self.logger.debug('DEBUG:: Skip: Target video file "{}" already exist!'.format(videofpath))
+            else:
+                # best guest if we already downloaded video file from previous runs
+                videotmpfpath = self.downloaded_video(job)
+                if videotmpfpath is not None:
+                    self.logger.debug('DEBUG:: Skip downloading: Video file "{}" already exist!'.format(videotmpfpath))
+                elif job.onepass:
+                    videotmpfpath = self.download_video_parts(job)
+                else:
+                    videotmpfpath = self.download_video(job)
+                #
+                # _ , ext    = os.path.splitext(videotmpfpath)
+                ext = '.mkv' if job.converttomkv else os.path.splitext(videotmpfpath)[1]
+                job.videotmpfpath = videotmpfpath
+                job.videofpath    = job.song_fpath + ext  # target output
+        # AUDIO (MP3)
+        job.downloaded_fname = None
+        if job.getaudio and job.isyoutube:
+            self.logger.info('')
+            self.logger.info('INFO:: Processing Audio "{}"'.format(job.song))
+            # 3. Download Audio
+            audiofpath    = job.song_fpath + '.mp3'
+            if self.is_done(job, 'audio', 'tagged', audiofpath):
+                self.logger.debug('DEBUG:: Skip: Target audio file "{}" already exist!'.format(audiofpath))
+            else:
+                if self.single_encode:
+                    # keep the source stream as is, stage_normalize encodes it to MP3 once
+                    audiotmpfpath = self.find_done(job, 'audio', 'downloaded',
+                                                   lambda: self.downloaded_audio_file_exist(job.audio_tmp_fpath))
+                    downloaded    = audiotmpfpath is not None
+                else:
+                    audiotmpfpath = job.audio_tmp_fpath + '.mp3'
+                    downloaded    = self.is_done(job, 'audio', 'downloaded', audiotmpfpath)
+                audiosrcfpath = self.local_audio_source(job) if self.audio_from_video and job.getvideo else None
+                if downloaded:
+                    self.logger.debug('DEBUG:: Skip downloading: Audio file "{}" already exist!'.format(audiotmpfpath))
+                elif audiosrcfpath is not None and self.single_encode:
+                    self.logger.info('INFO:: Using audio "{}" from {}'.format(job.song, audiosrcfpath))
+                    audiotmpfpath = audiosrcfpath
+                else:
+                    audiotmpfpath = self.download_audio(job, audiosrcfpath)
+                job.audiotmpfpath = audiotmpfpath
+                job.audiofpath    = audiofpath
+    #
+    def downloaded_video(self, job):
+        '''
+        Video downloaded by previous runs, None if not downloaded yet. For one pass video,
+        its video stream, when the audio stream is there too
+        '''
+        if job.onepass:
+            parts = self.video_parts(job)
+            return parts[0] if parts is not None else None
+        return self.find_done(job, 'video', 'downloaded',
+                              lambda: self.downloaded_video_file_exist(job.video_tmp_fpath))
+    #
+    def video_parts(self, job):
+        '''
+        One pass video: (video stream file, audio stream file, [(subtitle file, language code)]) downloaded
+        as <video tmp>.f<format id>.<ext> and <video tmp>.f<format id>.<language>.<ext>,
+        None if a stream is missing
+        '''
+        video_tmp_dir, video_tmp_name = os.path.split(job.video_tmp_fpath)
+        try:
+            fnames = sorted(os.listdir(video_tmp_dir))
+        except OSError:
+            return None
+        videofile, audiofile, subfiles = None, None, {}
+        for fname in fnames:
+            m = re.match(re.escape(video_tmp_name) + r'\.f[^.]+\.(?:([a-zA-Z-]+)\.)?([^.]+)$', fname)
+            if m is None or m.group(2) in ('part', 'ytdl', 'tmp'):
+                continue
+            fpath = os.path.join(video_tmp_dir, fname)
+            if m.group(1):
+                if m.group(2) in self.SUBTITLE_FILE_EXT:
+                    subfiles.setdefault(m.group(1), fpath)
+            elif self.has_video_stream(fpath):
+                videofile = videofile or fpath
+            else:
+                audiofile = audiofile or fpath
+        if videofile is None or audiofile is None:
+            return None
+        return videofile, audiofile, [(fpath, lang) for lang, fpath in sorted(subfiles.items())]
+    #
+    def download_video_parts(self, job):
+        '''
+        One pass video: download the video and audio streams and the subtitle as they are, without
+        youtube-dl merge, convert and embed, or fill them from the store. stage_normalize merges
+        them in one remux. Returns the video stream file
+        '''
+        with self.store_slot(job, 'video-parts'):
+            if self.store is not None:
+                filled = [self.store.fill(self.media_key(job), product, job.video_tmp_fpath + suffix)
+                          for product, suffix in self.VIDEO_PARTS]
+                if filled[0] is not None and filled[1] is not None:
+                    return filled[0]
+            #
+            self.logger.info('INFO:: Downloading video and audio streams: {} ...'.format(job.song))
+            ydl_parts_opts = {
+                'outtmpl'        : job.video_tmp_fpath + '.f%(format_id)s.%(ext)s',
+                'format'         : 'bestvideo,bestaudio',   # two files, not merged
+                'writesubtitles' : True,
+                'subtitleslangs' : ['en']
+            }
+            self.logger.debug('DEBUG:: Options: {}'.format({**self.ydl_opts, **ydl_parts_opts}))
+            try:
+                self.ydl_download(job, {**self.ydl_opts, **ydl_parts_opts})
+            except need('youtube_dl').utils.YoutubeDLError as e:
+                raise DLYoutubeDLError('Abort downloading Video "{}": {}'.format(job.song, e)) from e
+            parts = self.video_parts(job)
+            if parts is None:
+                raise DLCommandError('Abort downloading Video "{}": no separate video and audio streams'.format(job.song))
+            if self.store is not None:
+                for (product, _), fpath in zip(self.VIDEO_PARTS, parts[:2] + tuple(f for f, _ in parts[2][:1])):
+                    self.store.add(self.media_key(job), product, fpath)
+        return parts[0]
+    #
+    def download_video(self, job):
+        '''
+        Download video into temporary folder, or fill it from the store. Returns the downloaded file
+        '''
+        ydl_opts = self.ydl_opts
+        product  = 'video-mkv' if job.converttomkv else 'video'
+        with self.store_slot(job, product):
+            if self.store is not None:
+                videotmpfpath = self.store.fill(self.media_key(job), product, job.video_tmp_fpath)
+                if videotmpfpath is not None:
+                    self.record_done(job, 'video', 'downloaded', videotmpfpath, digest=not job.isyoutube)
+                    return videotmpfpath
+            #
+            self.logger.info('INFO:: Downloading video: {} ...'.format(job.song))
+            vpostprocessors = []
+            ydl_video_opts = {
+                'outtmpl'        : job.video_tmp_fpath + '.%(ext)s'
+            }
+            #
+            if job.converttomkv:
+                vpostprocessors.append({
+                    'key'           : 'FFmpegVideoConvertor',
+                    'preferedformat': 'mkv'
+                })
             #
-            isyoutube    = self.isYoutubeLink(dlink)
-            if self.convert_to_mkv is True or isyoutube is True:
-                converttomkv = True
+            if job.isyoutube:
+                ydl_video_opts.update({'format'               : 'bestvideo+bestaudio'})
+                ydl_video_opts.update({'writesubtitles'       : True})  # --write-sub
+                ydl_video_opts.update({'embedsubtitles'       : True})  # --embed-subs
+                # ydl_video_opts.update({'subtitlesformat'      : 'srt'})
+                ydl_video_opts.update({'subtitleslangs'       : ['en']})
+                vpostprocessors.append({'key'   : 'FFmpegEmbedSubtitle'})
+            #
+            if vpostprocessors:
+                ydl_video_opts.update({'postprocessors' : vpostprocessors})
+            # FFmpegVideoConvertor re-encodes the video, merge and subtitle embed copy it
+            threads = self.cpu.threads('video' if job.converttomkv else 'audio', self.extract_info(job.dlink).get('duration'))
+            ydl_video_opts.update({'postprocessor_args' : ['-threads', str(threads)]})
+            #
+            self.logger.debug('DEBUG:: Downlink: {}'.format(job.dlink))
+            self.logger.debug('DEBUG:: Options: {}'.format({**ydl_opts, **ydl_video_opts}))
+            try:
+                self.ydl_download(job, {**ydl_opts, **ydl_video_opts}, threads)
+            except need('youtube_dl').utils.YoutubeDLError as e:
+                raise DLYoutubeDLError('Abort downloading Video "{}": {}'.format(job.song, e)) from e
+            except Exception:
+                raise
+            # we now know the actual downloaded filename including the extension
+            if job.converttomkv:
+                # youtube downloaded filename: *.f251.mp4 and *.f251.webm
+                videotmpfpath = job.video_tmp_fpath + '.mkv'
             else:
-                converttomkv = False
+                # non youtube downloaded filename: *.mp4
+                videotmpfpath = job.downloaded_fname  # output of YoutubeDL, as input for FFmpegNormalize
+            # a youtube video is normalized, a non youtube one placed as is
+            self.record_done(job, 'video', 'downloaded', videotmpfpath, digest=not job.isyoutube)
+            if self.store is not None:
+                self.store.add(self.media_key(job), product, videotmpfpath)
+        return videotmpfpath
+    #
+    def download_audio(self, job, audiosrcfpath):
+        '''
+        Download audio into temporary folder, or extract it from audiosrcfpath when given,
+        or fill it from the store. Returns the downloaded file
+        '''
+        ydl_opts = self.ydl_opts
+        product  = 'audio-src' if self.single_encode else 'audio-mp3'
+        with self.store_slot(job, product):
+            if self.store is not None:
+                audiotmpfpath = self.store.fill(self.media_key(job), product, job.audio_tmp_fpath)
+                if audiotmpfpath is not None:
+                    self.record_done(job, 'audio', 'downloaded', audiotmpfpath, digest=False)
+                    return audiotmpfpath
+            #
+            audiotmpfpath = job.audio_tmp_fpath + '.mp3'
+            if audiosrcfpath is not None:
+                self.logger.info('INFO:: Extracting audio "{}" from {} ...'.format(job.song, audiosrcfpath))
+                self.extract_audio(audiosrcfpath, audiotmpfpath)
+            else:
+                self.logger.info('INFO:: Downloading audio "{}" ...'.format(job.song))
+                ydl_audio_opts = {
+                    'format'         : 'bestaudio',
+                    'verbose'        : True,
+                    'outtmpl'        : job.audio_tmp_fpath + '.%(ext)s'
+                }
+                if not self.single_encode:
+                    ydl_audio_opts.update({'postprocessors' : [{
+                        'key'             : 'FFmpegExtractAudio',
+                        'preferredcodec'  : 'mp3',
+                        'preferredquality': '320',
+                        'nopostoverwrites': False
+                    }]})
+                    ydl_audio_opts.update({'postprocessor_args' : ['-threads', str(self.cpu.threads('audio'))]})
+                pp = pprint.PrettyPrinter(indent=2)
+                self.logger.debug('DEBUG:: YoutubeDL Options: ' + pp.pformat({**ydl_opts, **ydl_audio_opts}))
+                try:
+                    self.ydl_download(job, {**ydl_opts, **ydl_audio_opts},
+                                      self.cpu.threads('audio') if not self.single_encode else None)
+                except need('youtube_dl').utils.YoutubeDLError as e:
+                    raise DLYoutubeDLError('Abort downloading Audio "{}": {}'.format(job.song, e)) from e
+                except Exception:
+                    raise
+                if self.single_encode:
+                    audiotmpfpath = job.downloaded_fname  # source stream, as input for normalization
+            self.record_done(job, 'audio', 'downloaded', audiotmpfpath, digest=False)
+            if self.store is not None:
+                self.store.add(self.media_key(job), product, audiotmpfpath)
+        return audiotmpfpath
+    #
+    def media_key(self, job):
+        '''
+        Store key of the row's media: <extractor>/<video id>
+        '''
+        if job.media_key is None:
+            info = self.extract_info(job.dlink)
+            job.media_key = '{}/{}'.format(*(re.sub('[^0-9a-zA-Z_-]+', '_', str(v))
+                                             for v in (info.get('extractor_key', 'generic'), info['id'])))
+            if self.store is not None:
+                self.protect_tmp(job, os.path.join(self.store.folder, job.media_key) + os.sep)
+        return job.media_key
+    #
+    def store_slot(self, job, product):
+        '''
+        Lock of the row's media product in the store, so rows sharing a media produce it once.
+        Does nothing without the store.
+        '''
+        if self.store is None:
+            return contextlib.ExitStack()
+        return self.store.slot(self.media_key(job), product)
+    #
+    def local_audio_source(self, job):
+        '''
+        Already downloaded file to extract the audio from, instead of downloading it again.
+        Prefer the audio stream kept by youtube-dl when merging (*.f<format id>.<ext>),
+        then the downloaded video itself. None if there is none.
+        '''
+        video_tmp_dir, video_tmp_name = os.path.split(job.video_tmp_fpath)
+        try:
+            fnames = sorted(os.listdir(video_tmp_dir))
+        except OSError:
+            fnames = []
+        for fname in fnames:
+            if re.match(re.escape(video_tmp_name) + r'\.f[^.]+\.[^.]+$', fname) and not fname.endswith('.part'):
+                fpath = os.path.join(video_tmp_dir, fname)
+                if not self.has_video_stream(fpath):
+                    return fpath
+        return job.videotmpfpath or self.downloaded_video_file_exist(job.video_tmp_fpath)
+    #
+    def has_video_stream(self, fpath):
+        # ffmpeg without output file prints the input streams and exits with error
+        proc = subprocess.run(['ffmpeg', '-hide_banner', '-i', fpath],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        return re.search(r'Stream #.*: Video:', proc.stderr) is not None
+    #
+    def extract_audio(self, infile, outfile):
+        '''
+        Transcode the audio of a local file to MP3, same as youtube-dl FFmpegExtractAudio
+        '''
+        tmpfile = outfile + '.part.mp3'
+        threads = self.cpu.threads('audio')
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', infile, '-vn',
+               '-c:a', 'libmp3lame', '-b:a', '320k', '-threads', str(threads), tmpfile]
+        self.logger.debug('DEBUG:: Running: {}'.format(' '.join(cmd)))
+        with self.metrics.span('extract_audio', file=outfile) as event:
+            returncode, stderr = self.cpu.run(cmd, threads, event)
+            if returncode != 0:
+                raise DLCommandError('ffmpeg failed extracting audio from {}: {}'.format(infile, stderr))
+            os.replace(tmpfile, outfile)
+            event['bytes'] = os.path.getsize(outfile)
+    #
+    def stage_normalize(self, job):
+        '''
+        Stage 2 (cpu bound): loudness normalize downloaded files next to their target
+        '''
+        self.metrics.set_job(job)
+        # 2. Normalize video. Input video from videotmpfpath, output video to videonormfpath
+        if job.videofpath is not None and job.isyoutube:  # no need normalize if it's not youtube
+            job.videonormfpath = self.norm_fpath(job, os.path.splitext(job.videofpath)[1])
+            if self.is_done(job, 'video', 'normalized', job.videonormfpath):
+                self.logger.debug('DEBUG:: Skip normalizing: Normalized video file "{}" already exist!'.format(job.videonormfpath))
+            else:
+                self.logger.info('INFO:: Normalizing file {} ...'.format(job.videotmpfpath))
+                self.normalize_job_file(job, 'video', job.videotmpfpath, job.videonormfpath)
+                # placed as is, its hash is carried to the output record
+                self.record_done(job, 'video', 'normalized', job.videonormfpath)
+                self.logger.info('INFO:: Normalizing done. Output file: {}'.format(job.videonormfpath))
+        # 5. Normalize audio
+        if job.audiofpath is not None:
+            job.audionormfpath = self.norm_fpath(job, '.mp3')
+            if self.is_done(job, 'audio', 'normalized', job.audionormfpath):
+                self.logger.debug('DEBUG:: Skip normalizing: Normalized audio file "{}" already exist!'.format(job.audionormfpath))
+            else:
+                self.logger.info('INFO:: Normalizing file: {}'.format(job.audiotmpfpath))
+                self.normalize_job_file(job, 'audio', job.audiotmpfpath, job.audionormfpath)
+                # tagged before placement, hashed then
+                self.record_done(job, 'audio', 'normalized', job.audionormfpath, digest=False)
+                self.logger.info('INFO:: Normalizing done. Output file: {}'.format(job.audionormfpath))
+    #
+    def norm_fpath(self, job, ext):
+        '''
+        Normalized file of the row, in the output folder: placed by a rename on the output
+        filesystem, not copied again from the temporary folder
+        '''
+        return job.song_fpath + '.norm' + ext
+    #
+    def normalize_job_file(self, job, kind, infile, outfile):
+        '''
+        Normalize infile to outfile, or fill it from the store
+        '''
+        if kind == 'video' and job.onepass:
+            product = 'video-onepass-norm'
+        elif kind == 'video':
+            product = ('video-mkv' if job.converttomkv else 'video') + '-norm'
+        else:
+            product = ('audio-src' if self.single_encode else 'audio-mp3') + '-norm'
+        # normalized audio is tagged in place later, it must not be a hardlink
+        hardlink = kind == 'video'
+        with self.store_slot(job, product):
+            if self.store is not None:
+                if self.store.fill(self.media_key(job), product, os.path.splitext(outfile)[0], hardlink=hardlink):
+                    return
+            if kind == 'video' and job.onepass:
+                parts = self.video_parts(job)
+                if parts is None:
+                    raise DLCommandError('Video or audio stream of "{}" is missing in {}'.format(
+                        job.song, os.path.dirname(job.video_tmp_fpath)))
+                self.video_loudnorm.remux(*parts, outfile)
+            else:
+                self.normalize(infile, outfile)
+            if self.store is not None:
+                self.store.add(self.media_key(job), product, outfile, hardlink=hardlink)
+    #
+    def normalize(self, infile, outfile):
+        # the video stream is copied, the work is the audio encode
+        threads = self.cpu.threads('audio')
+        if self.loudnorm is not None:
+            self.loudnorm.normalize(infile, outfile, threads=threads)
+            return
+        ffmpeg_normalize = need('ffmpeg_normalize').FFmpegNormalize(
+            dual_mono        = True,
+            progress         = True,
+            audio_codec      = 'libmp3lame',   # -c:a libmp3lame
+            audio_bitrate    = '320k',         # -b:a 320k
+            target_level     = -14.0,          # -t -14
+            extra_output_options = ['-threads', str(threads)]
+        )
+        # written under a temporary name, a partial outfile would be taken as normalized on next run
+        tmpfile = '{}.part{}'.format(*os.path.splitext(outfile))
+        ffmpeg_normalize.add_media_file(infile, tmpfile)
+        # both passes in one call, not told apart as loudness_measure and normalize_encode
+        with self.metrics.span('normalize', file=outfile) as event, self.cpu.slot(threads, event):
+            ffmpeg_normalize.run_normalization()
+            os.replace(tmpfile, outfile)
+            event['bytes'] = os.path.getsize(outfile)
+    #
+    def stage_tag(self, job):
+        '''
+        Stage 3 (disk bound): update ID3 tag and place files into output folder
+        '''
+        self.metrics.set_job(job)
+        if job.videofpath is not None:
+            if not job.isyoutube:
+                sha1   = self.done_digest(job, 'video', 'downloaded')
+                method = self.place(job.videotmpfpath, job.videofpath, self.place_strategy)
+                if method == 'rename':
+                    self.forget_done(job, 'video', 'downloaded')
+                self.logger.info('INFO:: Placing done ({}). Output file: {}'.format(method, job.videofpath))
+            else:
+                sha1 = self.done_digest(job, 'video', 'normalized')
+                self.place(job.videonormfpath, job.videofpath, 'rename')
+                self.forget_done(job, 'video', 'normalized')
+                self.logger.info('INFO:: Video output file: {}'.format(job.videofpath))
+            # same content as placed, not read again
+            self.record_done(job, 'video', 'tagged', job.videofpath, digest=sha1 or False)
+        #
+        if job.audiofpath is not None:
+            # 4. Update ID3 tag, after normalization, so the tags are not lost by ffmpeg
+            self.logger.info('INFO:: Updating MP3 ID3 tag ...')
+            audio = need('mutagen.id3').ID3(job.audionormfpath)
+            for key, frame in self.id3_frames(job).items():
+                audio[key] = frame
             #
             try:
-                # VIDEO (including it's audio, of course)
-                self.downloaded_fname = None
-                if getvideo:
-                    self.logger.info('')
-                    self.logger.info('INFO:: Processing Video "{}"'.format(song))
-                    # best guest if we already downloaded video file from previous runs
-                    videotmpfpath = self.downloaded_video_file_exist(video_tmp_fpath)
-                    # best guest if we already have target normalized video file
-                    videofpath    = self.downloaded_video_file_exist(song_fpath)
-                    #
-                    # 1. Download video. Input: youtube link, output: file in videotmpfpath folder
-                    #
-                    if videofpath is not None:
-                        self.logger.debug('DEBUG:: Skip: Target video file "{}" already exist!'.format(videofpath))
-                    else:
-                        if videotmpfpath is not None:
-                            self.logger.debug('DEBUG:: Skip downloading: Video file "{}" already exist!'.format(videotmpfpath))
-                        else:
-                            self.logger.info('INFO:: Downloading video: {} ...'.format(song))
-                            vpostprocessors = []
-                            ydl_video_opts = {
-                                'outtmpl'        : video_tmp_fpath + '.%(ext)s'
-                            }
-                            #
-                            if converttomkv:
-                                vpostprocessors.append({
-                                    'key'           : 'FFmpegVideoConvertor',
-                                    'preferedformat': 'mkv'
-                                })
-                            #
-                            if isyoutube:
-                                ydl_video_opts.update({'format'               : 'bestvideo+bestaudio'})
-                                ydl_video_opts.update({'writesubtitles'       : True})  # --write-sub
-                                ydl_video_opts.update({'embedsubtitles'       : True})  # --embed-subs
-                                # ydl_video_opts.update({'subtitlesformat'      : 'srt'})
-                                ydl_video_opts.update({'subtitleslangs'       : ['en']})
-                                vpostprocessors.append({'key'   : 'FFmpegEmbedSubtitle'})
-                            #
-                            if vpostprocessors:
-                                ydl_video_opts.update({'postprocessors' : vpostprocessors})
-                            #
-                            self.logger.debug('DEBUG:: Downlink: {}'.format(dlink))
-                            self.logger.debug('DEBUG:: Options: {}'.format({**ydl_opts, **ydl_video_opts}))
-                            try:
-                                with youtube_dl.YoutubeDL({**ydl_opts, **ydl_video_opts}) as ydl:
-                                    ydl.download([dlink])
-                            except youtube_dl.utils.YoutubeDLError:
-                                raise DLYoutubeDLError('Abort downloading Video "{}"'.format(song))
-                            except Exception:
-                                raise
-                            # we now know the actual downloaded filename including the extension
-                            if converttomkv:
-                                # youtube downloaded filename: *.f251.mp4 and *.f251.webm
-                                videotmpfpath = video_tmp_fpath + '.mkv'
-                            else:
-                                # non youtube downloaded filename: *.mp4
-                                videotmpfpath = self.downloaded_fname  # output of YoutubeDL, as input for FFmpegNormalize
-                        #
-                        # _ , ext    = os.path.splitext(videotmpfpath)
-                        ext = '.mkv' if converttomkv else os.path.splitext(videotmpfpath)[1]
-                        videofpath = song_fpath + ext  # target output of FFmpegNormalize
-                        # Delete existing target normalized video, if any
-                        # try:
-                        #     os.remove(videofpath)
-                        # except OSError:
-                        #     pass
-                        #
-                        # 2. Normalize video. Input video from videotmpfpath, output video to videofpath
-                        #
-                        if os.path.isfile(videofpath):
-                            self.logger.debug('DEBUG:: Skip normalizing: Target video file "{}" already exist!'.format(videofpath))
-                        else:
-                            if not isyoutube: # no need normalize if it's not youtube
-                                shutil.copyfile(videotmpfpath, videofpath)
-                                self.logger.info('INFO:: Copying done. Output file: {}'.format(videofpath))
-                            else:
-                                self.logger.info('INFO:: Normalizing file {} ...'.format(videotmpfpath))
-                                ffmpeg_normalize = FFmpegNormalize(
-                                    dual_mono        = True,
-                                    progress         = True,
-                                    audio_codec      = 'libmp3lame',   # -c:a libmp3lame
-                                    audio_bitrate    = '320k',         # -b:a 320k
-                                    target_level     = -14.0           # -t -14
-                                )
-                                ffmpeg_normalize.add_media_file(videotmpfpath, videofpath)
-                                ffmpeg_normalize.run_normalization()
-                                self.logger.info('INFO:: Normalizing done. Output file: {}'.format(videofpath))
-                # AUDIO (MP3)
-                self.downloaded_fname = None
-                if getaudio and isyoutube:
-                    self.logger.info('')
-                    self.logger.info('INFO:: Processing Audio "{}"'.format(song))
-                    # 3. Download Audio
-                    audiotmpfpath = audio_tmp_fpath + '.mp3'
-                    audiofpath    = song_fpath + '.mp3'
-                    if os.path.isfile(audiofpath):
-                        self.logger.debug('DEBUG:: Skip: Target audio file "{}" already exist!'.format(audiofpath))
-                    else:
-                        if os.path.isfile(audiotmpfpath):
-                            self.logger.debug('DEBUG:: Skip downloading: Audio file "{}" already exist!'.format(audiotmpfpath))
-                        else:
-                            self.logger.info('INFO:: Downloading audio "{}" ...'.format(song))
-                            ydl_audio_opts = {
-                                'format'         : 'bestaudio',
-                                'verbose'        : True,
-                                'postprocessors' : [{
-                                    'key'             : 'FFmpegExtractAudio',
-                                    'preferredcodec'  : 'mp3',
-                                    'preferredquality': '320',
-                                    'nopostoverwrites': False
-                                }],
-                                'outtmpl'        : audio_tmp_fpath + '.%(ext)s'
-                            }
-                            pp = pprint.PrettyPrinter(indent=2)
-                            self.logger.debug('DEBUG:: YoutubeDL Options: ' + pp.pformat({**ydl_opts, **ydl_audio_opts}))
-                            try:
-                                with youtube_dl.YoutubeDL({**ydl_opts, **ydl_audio_opts}) as ydl:
-                                    ydl.download([dlink])
-                            except youtube_dl.utils.YoutubeDLError:
-                                raise DLYoutubeDLError('Abort downloading Audio "{}"'.format(song))
-                            except Exception:
-                                raise
-                            # 4. Update ID3 tag
-                            self.logger.info('INFO:: Updating MP3 ID3 tag ...')
-                            audio = ID3(audiotmpfpath)
-                            audio[self.ALBUMARTIST] = TPE2(encoding=3, text=albumartist)
-                            audio[self.ALBUM]       = TALB(encoding=3, text=album)
-                            audio[self.TITLE]       = TIT2(encoding=3, text=song)
-                            audio[self.ARTIST]      = TPE1(encoding=3, text=artist)
-                            audio[self.GENRE]       = TCON(encoding=3, text=genre)
-                            audio[self.YEAR]        = TYER(encoding=3, text=year)
-                            audio[self.DATE]        = TDAT(encoding=3, text=year)
-                            audio[self.DLINK]       = LINK(encoding=3, url=dlink)
-
-                            try:
-                                with open(os.path.join(self.coverFolder, cover), 'rb') as albumart:
-                                    audio['APIC'] = APIC(encoding=3, mime='image/jpg', type=3,
-                                                        desc=u'Cover', data=albumart.read())
-                            except Exception as e:
-                                self.logger.debug('DEBUG:: Skipped album art file error: {}'.format(e))
-                            #
-                            try:
-                                audio.save()
-                                self.logger.info('INFO:: Audio ID3 Tag completed on file: {}'.format(audiotmpfpath))
-                                self.logger.info('INFO::   Title        : ' + audio[self.TITLE].text[0])
-                                self.logger.info('INFO::   Album        : ' + audio[self.ALBUM].text[0])
-                                self.logger.info('INFO::   Album Artist : ' + audio[self.ALBUMARTIST].text[0])
-                                self.logger.info('INFO::   Artist       : ' + audio[self.ARTIST].text[0])
-                                self.logger.info('INFO::   Genre        : ' + audio[self.GENRE].text[0])
-                                self.logger.info('INFO::   Year         : ' + audio[self.YEAR].text[0])
-                                self.logger.info('INFO::   Date         : ' + audio[self.DATE].text[0])
-                                self.logger.info('INFO::   Link         : ' + audio[self.DLINK].url)
-                            except Exception:
-                                self.logger.error('ERROR:: Error on saving ID3 tag!')
-                            #
-                            # Since we've updated the metadata, we need to normalize again.
-                            # Hence, delete target
-                            try:
-                                os.remove(audiofpath)
-                            except OSError:
-                                pass
-                        # 5. Normalize audio
-                        if os.path.isfile(audiofpath):
-                            self.logger.debug('DEBUG:: Skip normalizing: Audio file "{}" already exist!'.format(audiofpath))
-                        else:
-                            self.logger.info('INFO:: Normalizing file: {}'.format(audiotmpfpath))
-                            ffmpeg_normalize = FFmpegNormalize(
-                                dual_mono        = True,
-                                progress         = True,
-                                audio_codec      = 'libmp3lame',   # -c:a libmp3lame
-                                audio_bitrate    = '320k',         # -b:a 320k
-                                target_level     = -14.0           # -t -14
-                            )
-                            ffmpeg_normalize.add_media_file(audiotmpfpath, audiofpath)
-                            ffmpeg_normalize.run_normalization()
-                            self.logger.info('INFO:: Normalizing done. Output file: {}'.format(audiofpath))
-                #
-            except DLYoutubeDLError as e:
-                self.logger.error('ERROR:: DLYoutubeDLError {}'.format(e))
+                with self.metrics.span('id3_save', file=job.audionormfpath):
+                    audio.save()
+                self.logger.info('INFO:: Audio ID3 Tag completed on file: {}'.format(job.audionormfpath))
+                self.logger.info('INFO::   Title        : ' + audio[self.TITLE].text[0])
+                self.logger.info('INFO::   Album        : ' + audio[self.ALBUM].text[0])
+                self.logger.info('INFO::   Album Artist : ' + audio[self.ALBUMARTIST].text[0])
+                self.logger.info('INFO::   Artist       : ' + audio[self.ARTIST].text[0])
+                self.logger.info('INFO::   Genre        : ' + audio[self.GENRE].text[0])
+                self.logger.info('INFO::   Year         : ' + audio[self.YEAR].text[0])
+                self.logger.info('INFO::   Date         : ' + audio[self.DATE].text[0])
+                self.logger.info('INFO::   Link         : ' + audio[self.DLINK].url)
+            except Exception:
+                self.logger.error('ERROR:: Error on saving ID3 tag!')
+            #
+            self.place(job.audionormfpath, job.audiofpath, 'rename')
+            self.forget_done(job, 'audio', 'normalized')
+            self.record_done(job, 'audio', 'tagged', job.audiofpath)
+            self.logger.info('INFO:: Audio output file: {}'.format(job.audiofpath))
+    #
+    def id3_frames(self, job):
+        '''
+        ID3 frames of the row, by frame name
+        '''
+        id3 = need('mutagen.id3')
+        frames = {self.ALBUMARTIST: id3.TPE2(encoding=3, text=job.albumartist),
+                  self.ALBUM      : id3.TALB(encoding=3, text=job.album),
+                  self.TITLE      : id3.TIT2(encoding=3, text=job.song),
+                  self.ARTIST     : id3.TPE1(encoding=3, text=job.artist),
+                  self.GENRE      : id3.TCON(encoding=3, text=job.genre),
+                  self.YEAR       : id3.TYER(encoding=3, text=job.year),
+                  self.DATE       : id3.TDAT(encoding=3, text=job.year),
+                  self.DLINK      : id3.LINK(encoding=3, url=job.dlink)}
+        try:
+            mime, data = self.covers.get(job.cover)
+            frames['APIC'] = id3.APIC(encoding=3, mime=mime, type=3, desc=u'Cover', data=data)
+        except Exception as e:
+            self.logger.debug('DEBUG:: Skipped album art file error: {}'.format(e))
+        return frames
+    #
+    def retag(self):
+        '''
+        Update the ID3 tag of MP3 already in output folder to their csv row, without downloading
+        or normalizing. Only changed frames are written, unchanged files are not written at all.
+        '''
+        need('mutagen.id3')  # fail early
+        if self.use_job_index:
+            self.jobindex = DLJobIndex(os.path.join(self.tempFolder, 'jobs.sqlite'), self.logger)
+        counts = {'rows': 0, 'updated': 0, 'unchanged': 0, 'missing': 0, 'failed': 0}
+        frames = {}   # frame id -> files updated
+        lock   = threading.Lock()
+        def retag_job(job):
+            try:
+                changed = self.retag_file(job, job.song_fpath + '.mp3')
+            except Exception as e:
+                self.logger.error('ERROR:: Retag failed on {}: {}'.format(job.song_fpath + '.mp3', e))
+                changed, result = [], 'failed'
+            else:
+                result = 'updated' if changed else 'unchanged'
+            with lock:
+                counts[result] += 1
+                for fid in changed:
+                    frames[fid] = frames.get(fid, 0) + 1
+        #
+        def playlist_rows(od):
+            try:
+                return list(self.expand_playlist(od, archive=False))
             except Exception as e:
                 self.logger.error('ERROR:: {}'.format(e))
+                return []
+        #
+        with ThreadPoolExecutor(max_workers=self.tag_jobs, thread_name_prefix='retag') as executor:
+            rows = (row for od in self.inputList if self.in_shard(od)
+                    for row in (playlist_rows(od) if self.is_playlist_row(od) else [od]))
+            for rowid, od in enumerate(rows, 1):
+                if '_error' in od:
+                    self.logger.error('ERROR:: {}'.format(od['_error']))
+                    continue
+                job = DLJob(od, rowid)
+                self.prepare_job(job, makedirs=False)
+                if not (job.getaudio and job.isyoutube):
+                    continue  # no MP3 for this row
+                counts['rows'] += 1
+                if not os.path.isfile(job.song_fpath + '.mp3'):
+                    self.logger.info('INFO:: Retag: not in output folder, skipped: {}'.format(job.song_fpath + '.mp3'))
+                    counts['missing'] += 1
+                    continue
+                executor.submit(retag_job, job)
+        if self.jobindex is not None:
+            self.jobindex.close()
+        print('Retag: {rows} MP3 rows, {updated} updated, {unchanged} unchanged, {missing} not in output folder, {failed} failed'.format(**counts))
+        if frames:
+            print('Retag: frames updated: {}'.format(', '.join('{} {}'.format(fid, n) for fid, n in sorted(frames.items()))))
+        return counts
+    #
+    def retag_file(self, job, fpath):
+        '''
+        Rewrite the frames of fpath which differ from the row. Returns the frame ids written
+        '''
+        id3    = need('mutagen.id3')
+        audio  = id3.ID3(fpath)
+        # compare as saved: mutagen writes ID3v2.4, where TYER and TDAT become TDRC
+        wanted = id3.ID3()
+        for frame in self.id3_frames(job).values():
+            wanted.add(frame)
+        wanted.update_to_v24()
+        changed = []
+        for fid in sorted({frame.FrameID for frame in wanted.values()}):
+            if sorted(map(repr, audio.getall(fid))) != sorted(map(repr, wanted.getall(fid))):
+                audio.setall(fid, wanted.getall(fid))
+                changed.append(fid)
+        if changed:
+            with self.metrics.span('retag', file=fpath, frames=changed):
+                audio.save()
+            self.record_done(job, 'audio', 'tagged', fpath)
+            self.logger.info('INFO:: Retag: {} updated: {}'.format(fpath, ', '.join(changed)))
+        else:
+            self.logger.debug('DEBUG:: Retag: {} unchanged'.format(fpath))
+        return changed
+    #
+    def place(self, src, dst, strategy):
+        with self.metrics.span('place', file=dst, strategy=strategy) as event:
+            event['method'] = place_file(src, dst, strategy)
+            event['bytes']  = os.path.getsize(dst)
+        return event['method']
 
-if __name__ == "__main__":
-    import argparse
+def args_to_opts(args):
+    '''
+    Command line arguments to DLYoutube options
+    '''
+    return { 'verbose'         : args.verbose,
+             'inputlist'       : args.inputlist,
+             'converttomkv'    : args.converttomkv,
+             'coverfolder'     : args.coverfolder,
+             'rmcachedir'      : args.rmcachedir,
+             'audiofromvideo'  : args.audiofromvideo,
+             'loudnesscache'   : args.loudnesscache,
+             'singleencode'    : args.singleencode,
+             'onepassvideo'    : args.onepassvideo,
+             'jobindex'        : args.jobindex,
+             'verify'          : args.verify,
+             'infottl'         : args.infottl,
+             'dedup'           : args.dedup,
+             'covermaxsize'    : args.covermaxsize,
+             'place'           : args.place,
+             'jobs'            : args.jobs,
+             'hostjobs'        : args.hostjobs,
+             'normjobs'        : args.normjobs,
+             'ffmpegcores'     : args.ffmpegcores,
+             'tagjobs'         : args.tagjobs,
+             'queuesize'       : args.queuesize,
+             'metricstextfile' : args.metricstextfile,
+             'retries'         : args.retries,
+             'retrydelay'      : args.retrydelay,
+             'hostrate'        : args.hostrate,
+             'limitrate'       : args.limitrate,
+             'tmpbudget'       : args.tmpbudget,
+             'progressinterval': args.progressinterval,
+             'archive'         : args.archive,
+             'playlistend'     : args.playlistend,
+             'listen'          : args.listen,
+             'watchfolder'     : args.watchfolder,
+             'watchinterval'   : args.watchinterval,
+             'shard'           : args.shard,
+             'leasedir'        : args.leasedir,
+             'leasettl'        : args.leasettl,
+             'folderoutput'    : args.outputfolder}
+
+def option_parser():
     # Note: The store_true option automatically creates a default value of False.
     #       Likewise, store_false will default to True when the command-line argument is not present.
     #
-    def main(args):
-        opts = { 'verbose'         : args.verbose,
-                 'inputlist'       : args.inputlist,
-                 'converttomkv'    : args.converttomkv,
-                 'coverfolder'     : args.coverfolder,
-                 'rmcachedir'      : args.rmcachedir,
-                 'folderoutput'    : args.outputfolder}
-        DLYoutube(**opts).main()
-
-    # setup parser
     parser = argparse.ArgumentParser(description='Youtube Downloader and Stuffs')
     parser.add_argument('--version', action='version', version=__progname_version__)
     parser.add_argument('-m', '--convert-to-mkv', dest='converttomkv', action='store_true', help='Video convert to mkv')
     parser.add_argument('-r', '--rm-cache-dir', dest='rmcachedir', action='store_true', help='Remove cache directory')
+    parser.add_argument('-a', '--audio-from-video', dest='audiofromvideo', action='store_true',
+                        help='For "av" rows, extract MP3 from the downloaded video instead of downloading audio again')
+    parser.add_argument('-l', '--loudness-cache', dest='loudnesscache', action='store_true',
+                        help='Cache loudness measurement, normalize the same input again in one ffmpeg pass')
+    parser.add_argument('-s', '--single-encode', dest='singleencode', action='store_true',
+                        help='Normalize and encode MP3 straight from the downloaded audio stream, without transcoding it first')
+    parser.add_argument('--one-pass-video', dest='onepassvideo', action='store_true',
+                        help='Merge youtube video and audio streams, embed subtitle and normalize audio in one ffmpeg remux, copying the video')
+    parser.add_argument('-d', '--job-db', dest='jobindex', action='store_true',
+                        help='Keep finished stages in a SQLite job index (tmp/jobs.sqlite) to skip them without probing files')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='Reconcile the job index against files on disk before processing (implies --job-db)')
+    parser.add_argument('--info-ttl', dest='infottl', type=int, default=0,
+                        help='Keep resolved link info in tmp/cache/info for this many seconds, at most 3 hours (default: 0, not kept)')
+    parser.add_argument('--dedup', dest='dedup', action='store_true',
+                        help='Download and normalize a media used by several rows once, via tmp/store')
+    parser.add_argument('-p', '--place', dest='place', choices=PLACE_STRATEGIES, default='auto',
+                        help='How downloaded files not normalized are placed in output folder (default: auto, '
+                             'hardlink else reflink else copy). rename does not keep the temporary file')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of concurrent downloads')
+    parser.add_argument('--host-jobs', dest='hostjobs', type=int, default=2, help='Max concurrent downloads per host')
+    parser.add_argument('--norm-jobs', dest='normjobs', type=int, default=None, help='Number of concurrent normalizations (default: cpu count)')
+    parser.add_argument('--ffmpeg-cores', dest='ffmpegcores', type=int, default=None,
+                        help='Cores shared by ffmpeg processes, each given threads by its work (default: cpu count)')
+    parser.add_argument('--tag-jobs', dest='tagjobs', type=int, default=1, help='Number of concurrent ID3 tag and file placement')
+    parser.add_argument('--queue-size', dest='queuesize', type=int, default=4, help='Max pending rows between stages')
+    parser.add_argument('--download-archive', dest='archive', default=None,
+                        help='File of playlist entries already done, skipped on next runs (default: tmp/archive.txt)')
+    parser.add_argument('--playlist-end', dest='playlistend', type=int, default=None,
+                        help='Expand playlist and channel rows up to this entry, e.g. latest uploads only (default: all)')
+    parser.add_argument('--retries', dest='retries', type=int, default=3,
+                        help='Retries of a row failing on a transient error, e.g. network (default: 3)')
+    parser.add_argument('--retry-delay', dest='retrydelay', type=float, default=30,
+                        help='Seconds before the first retry, doubled on each next one, with jitter (default: 30)')
+    parser.add_argument('--host-rate', dest='hostrate', type=float, default=0,
+                        help='Max requests per minute to the same host (default: 0, no limit)')
+    parser.add_argument('--limit-rate', dest='limitrate', default=None,
+                        help='Max download bandwidth per host in bytes per second, e.g. 500K, 2M (default: no limit)')
+    parser.add_argument('--tmp-budget', dest='tmpbudget', default=None,
+                        help='Max size of temporary downloads, store and info cache, e.g. 20G. Least recently used '
+                             'files of rows already in output folder are removed first (default: no limit)')
+    parser.add_argument('--shard', dest='shard', default=None,
+                        help='Process only shard i of N (i/N, 1 <= i <= N) of the rows, split by link')
+    parser.add_argument('--lease-dir', dest='leasedir', default=None,
+                        help='Shared folder where nodes claim links with lease files, so each media is done by one node')
+    parser.add_argument('--lease-ttl', dest='leasettl', type=int, default=300,
+                        help='Seconds after which a lease of a crashed node is reclaimed (default: 300)')
+    parser.add_argument('--retag', dest='retag', action='store_true',
+                        help='Only update ID3 tag of MP3 already in output folder to the input list, changed frames only')
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help='Print the steps each row would run, with counts, and exit without running them')
+    parser.add_argument('--daemon', dest='daemon', action='store_true',
+                        help='Keep running, taking rows from the api (--listen) and the watch folder (--watch-folder)')
+    parser.add_argument('--listen', dest='listen', default=None,
+                        help='Daemon job api on host:port, or on a unix socket path (default: 127.0.0.1:8642)')
+    parser.add_argument('--watch-folder', dest='watchfolder', default=None,
+                        help='Daemon reads new and appended *.csv input files in this folder')
+    parser.add_argument('--watch-interval', dest='watchinterval', type=float, default=2,
+                        help='Seconds between watch folder scans (default: 2)')
+    parser.add_argument('--metrics-textfile', dest='metricstextfile', default=None,
+                        help='Write per stage metrics to this Prometheus textfile collector file (*.prom)')
+    parser.add_argument('--progress-interval', dest='progressinterval', type=float, default=5,
+                        help='Seconds between download progress log lines of the same download, with -vv (default: 5)')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='increase verbosity. Specify multiple times for increased diagnostic output.')
     parser.add_argument('-c', '--coverfolder', dest='coverfolder', default=None, help='Cover art folder')
-    parser.add_argument('-i', '--inputlist', dest='inputlist', required=True, help='List input')
+    parser.add_argument('--cover-max-size', dest='covermaxsize', type=int, default=None,
+                        help='Downscale cover art larger than this many pixels (width or height) to JPEG')
+    parser.add_argument('-i', '--inputlist', dest='inputlist', default=None, help='List input (optional with --daemon)')
     parser.add_argument('-o', '--outputfolder', dest='outputfolder', default=None, help='Folder output')
+    return parser
+
+if __name__ == "__main__":
+    def main(args):
+        if args.daemon:
+            opts = args_to_opts(args)
+            if not opts['listen'] and not opts['watchfolder']:
+                opts['listen'] = '127.0.0.1:8642'
+            DLYoutube(**opts).daemon()
+        elif args.inputlist is None:
+            raise DLReqError('the following arguments are required: -i/--inputlist')
+        elif args.plan:
+            DLYoutube(**args_to_opts(args)).plan()
+        elif args.retag:
+            DLYoutube(**args_to_opts(args)).retag()
+        else:
+            DLYoutube(**args_to_opts(args)).main()
+
+    # setup parser
+    parser = option_parser()
     parser.set_defaults(func=main)
     #
     args = parser.parse_args()